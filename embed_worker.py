@@ -0,0 +1,20 @@
+import numpy as np
+from embedder import encode, get_model, get_template_embeddings
+
+# Template matrix owned by the worker process, set by load()
+_template_embeddings = None
+
+def load(templates):
+    """Load the model and template embeddings once, when the worker process starts."""
+    global _template_embeddings
+    get_model()
+    # float32, like the embeddings classify() scores, so the product runs on BLAS
+    _template_embeddings = get_template_embeddings(tuple(templates))
+
+def classify(texts, batch_size=16):
+    """Return (template index, cosine similarity) of the best template for each text."""
+    embeddings = encode(texts, batch_size=batch_size)
+    # With only a few templates one matrix product beats an index search
+    scores = embeddings @ _template_embeddings.T
+    indices = np.argmax(scores, axis=1)
+    return [(int(template_idx), float(scores[row, template_idx])) for row, template_idx in enumerate(indices)]
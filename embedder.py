@@ -0,0 +1,74 @@
+import os
+import hashlib
+import functools
+
+# Sentence transformer model used for embeddings, run through ONNX Runtime
+MODEL_NAME = 'sentence-transformers/all-MiniLM-L6-v2'
+ONNX_MODEL_DIR = 'onnx_minilm'
+QUANTIZED_MODEL_DIR = 'onnx_minilm_int8'
+MAX_SEQ_LENGTH = 256
+ENCODE_BATCH_SIZE = 32
+
+def export_quantized_model():
+    """Export MiniLM to ONNX and quantize its linear layers to int8 (one-time)."""
+    from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    from transformers import AutoTokenizer
+    if not os.path.isdir(ONNX_MODEL_DIR):
+        model = ORTModelForFeatureExtraction.from_pretrained(MODEL_NAME, export=True)
+        model.save_pretrained(ONNX_MODEL_DIR)
+        AutoTokenizer.from_pretrained(MODEL_NAME).save_pretrained(ONNX_MODEL_DIR)
+    # Dynamic quantization: int8 weights, activations quantized on the fly (VNNI on x86)
+    quantizer = ORTQuantizer.from_pretrained(ONNX_MODEL_DIR)
+    quantization_config = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+    quantizer.quantize(save_dir=QUANTIZED_MODEL_DIR, quantization_config=quantization_config)
+    AutoTokenizer.from_pretrained(ONNX_MODEL_DIR).save_pretrained(QUANTIZED_MODEL_DIR)
+
+@functools.lru_cache(maxsize=1)
+def get_model():
+    """Load the int8 ONNX Runtime model and its tokenizer once per process."""
+    # Heavy runtime imports are deferred until a thread actually needs encoding
+    import onnxruntime
+    from optimum.onnxruntime import ORTModelForFeatureExtraction
+    from transformers import AutoTokenizer
+    if not os.path.isdir(QUANTIZED_MODEL_DIR):
+        export_quantized_model()
+    session_options = onnxruntime.SessionOptions()
+    session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    session_options.intra_op_num_threads = os.cpu_count() or 1
+    model = ORTModelForFeatureExtraction.from_pretrained(
+        QUANTIZED_MODEL_DIR, file_name='model_quantized.onnx',
+        provider='CPUExecutionProvider', session_options=session_options)
+    tokenizer = AutoTokenizer.from_pretrained(QUANTIZED_MODEL_DIR)
+    return model, tokenizer
+
+def encode(texts, batch_size=ENCODE_BATCH_SIZE):
+    """Encode texts into L2-normalized float32 sentence embeddings."""
+    import numpy as np
+    model, tokenizer = get_model()
+    embeddings = np.empty((len(texts), model.config.hidden_size), dtype=np.float32)
+    # Batch similar lengths together so little compute is spent on padding
+    order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+    for start in range(0, len(texts), batch_size):
+        batch = order[start:start + batch_size]
+        inputs = tokenizer([texts[i] for i in batch], padding=True, truncation=True,
+                           max_length=MAX_SEQ_LENGTH, return_tensors='np')
+        token_embeddings = model(**inputs).last_hidden_state
+        # Mean-pool over real tokens only, then normalize like sentence-transformers does
+        mask = inputs['attention_mask'][..., None].astype(np.float32)
+        pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        embeddings[batch] = pooled / np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+    return embeddings
+
+@functools.lru_cache(maxsize=None)
+def get_template_embeddings(templates):
+    """Load (or encode and cache) embeddings for a tuple of templates."""
+    import numpy as np
+    # Reuse embeddings cached on disk for this exact model and template set
+    digest = hashlib.sha256("\n".join((MODEL_NAME, QUANTIZED_MODEL_DIR) + templates).encode()).hexdigest()
+    cache_path = f'templates_{digest[:16]}.npy'
+    if not os.path.exists(cache_path):
+        # Normalized rows turn cosine similarity into a plain dot product
+        np.save(cache_path, encode(list(templates)).astype(np.float16))
+    # Stored as float16 to halve the cache; scored in float32 so the product stays on BLAS
+    return np.load(cache_path).astype(np.float32)
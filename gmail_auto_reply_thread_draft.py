@@ -1,51 +1,28 @@
-import os
 import time
 import base64
-from email.mime.text import MIMEText
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from google.auth.transport.requests import Request
+import queue
+from googleapiclient.errors import HttpError
 import email.utils
+from gmail_client import (NOTIFICATION_TIMEOUT, WATCH_RENEW_SECONDS, authenticate_gmail, encode_header,
+                          execute_batch, get_history_id, get_new_unread_emails, get_threads, get_unread_emails,
+                          mark_emails_as_read, start_notification_listener, watch_mailbox)
 
-# Gmail API scope for reading emails and creating drafts
-SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
+# Error backoff doubles from INITIAL_BACKOFF up to MAX_BACKOFF seconds
+INITIAL_BACKOFF = 1.0
+MAX_BACKOFF = 300
 
-def authenticate_gmail():
-    """Authenticate with Gmail API and return the service object."""
-    creds = None
-    if os.path.exists('token.json'):
-        creds = Credentials.from_authorized_user_file('token.json', SCOPES)
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file(
-                'credentials.json', SCOPES)
-            creds = flow.run_local_server(port=0)
-        with open('token.json', 'w') as token:
-            token.write(creds.to_json())
-    
-    return build('gmail', 'v1', credentials=creds)
-
-def get_unread_emails(service):
-    """Retrieve unread emails from the inbox."""
-    results = service.users().messages().list(userId='me', labelIds=['INBOX'], q='is:unread').execute()
-    messages = results.get('messages', [])
-    return messages
-
-def get_thread_details(service, thread_id):
-    """Get all messages in a thread and extract details."""
-    thread = service.users().threads().get(userId='me', id=thread_id).execute()
+def get_thread_details(thread):
+    """Extract details from all messages in a fetched thread."""
     messages = thread.get('messages', [])
     
     thread_details = []
     for msg in messages:
-        headers = msg['payload']['headers']
-        subject = next((header['value'] for header in headers if header['name'] == 'Subject'), '')
-        from_email = next((header['value'] for header in headers if header['name'] == 'From'), '')
-        message_id = next((header['value'] for header in headers if header['name'] == 'Message-ID'), '')
-        date = next((header['value'] for header in headers if header['name'] == 'Date'), '')
+        # Index headers once instead of scanning the list for every field
+        headers = {header['name']: header['value'] for header in msg['payload']['headers']}
+        subject = headers.get('Subject', '')
+        from_email = headers.get('From', '')
+        message_id = headers.get('Message-ID', '')
+        date = headers.get('Date', '')
         
         # Extract message body (simplified, assumes text/plain part)
         body = ''
@@ -68,7 +45,7 @@ def get_thread_details(service, thread_id):
     return thread_details, messages[-1]['id']  # Return thread details and latest message ID
 
 def create_draft_reply(service, to_email, subject, thread_id, latest_message_id, thread_details):
-    """Create a draft reply for the email thread."""
+    """Build the request creating a draft reply for the email thread."""
     # Create reply content, quoting the latest message
     latest_message = thread_details[-1]
     reply_content = f"""
@@ -81,72 +58,145 @@ Best regards,
 > {latest_message['body']}
 """
 
-    message = MIMEText(reply_content)
-    message['to'] = to_email
-    message['subject'] = f"Re: {subject}"
-    message['In-Reply-To'] = latest_message_id
-    message['References'] = latest_message_id
+    # Assemble the RFC 822 message directly instead of running the email package generator
+    raw = (
+        f"To: {encode_header(to_email)}\r\n"
+        f"Subject: {encode_header(f'Re: {subject}')}\r\n"
+        f"In-Reply-To: {latest_message_id}\r\n"
+        f"References: {latest_message_id}\r\n"
+        "MIME-Version: 1.0\r\n"
+        "Content-Type: text/plain; charset=utf-8\r\n"
+        "Content-Transfer-Encoding: 8bit\r\n"
+        "\r\n"
+        f"{reply_content}"
+    ).encode('utf-8')
 
-    raw_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
+    raw_message = base64.urlsafe_b64encode(raw).decode()
     draft = {
         'message': {
             'raw': raw_message,
             'threadId': thread_id
         }
     }
-    return service.users().drafts().create(userId='me', body=draft).execute()
+    return service.users().drafts().create(userId='me', body=draft)
 
-def mark_email_as_read(service, msg_id):
-    """Mark an email as read."""
-    service.users().messages().modify(
-        userId='me',
-        id=msg_id,
-        body={'removeLabelIds': ['UNREAD']}
-    ).execute()
+def process_messages(service, credentials, messages):
+    """Create draft replies for unread messages, mark them as read and return those to retry."""
+    if not messages:
+        print("No new unread emails found.")
+        return []
+    print(f"Found {len(messages)} unread emails.")
+    failed = []  # Messages that still need a draft
+    # Fetch every referenced thread up front in batched requests
+    threads = get_threads(service, credentials, list(dict.fromkeys(message['threadId'] for message in messages)))
+    draft_requests = []
+    pending = []  # (msg_id, thread_id) for each queued draft
+    for message in messages:
+        msg_id = message['id']
+        thread_id = message['threadId']
+        print(f"Processing email with message ID: {msg_id} in thread: {thread_id}")
+        
+        thread = threads.get(thread_id)
+        if not thread:
+            print(f"Could not fetch thread {thread_id}. Will retry.")
+            failed.append(message)
+            continue
+        
+        # Get thread details
+        thread_details, latest_message_id = get_thread_details(thread)
+        if not thread_details:
+            print(f"No details found for thread {thread_id}. Skipping.")
+            continue
+        
+        # Use details from the latest message for the reply
+        latest_message = thread_details[-1]
+        to_email = latest_message['from']
+        subject = latest_message['subject']
+        
+        print(f"Thread contains {len(thread_details)} messages. Latest from: {to_email}, Subject: {subject}")
+        
+        # Queue draft reply
+        draft_requests.append(create_draft_reply(service, to_email, subject, thread_id, latest_message_id, thread_details))
+        pending.append((msg_id, thread_id))
+    
+    # Create all drafts in batched requests
+    drafts = execute_batch(service, credentials, draft_requests)
+    read_ids = []
+    for (msg_id, thread_id), draft in zip(pending, drafts):
+        if draft:
+            print(f"Draft created for thread {thread_id}. Draft ID: {draft['id']}")
+            read_ids.append(msg_id)
+        else:
+            failed.append({'id': msg_id, 'threadId': thread_id})
+    
+    # Mark the emails that got a draft as read
+    if read_ids:
+        mark_emails_as_read(service, read_ids)
+        print(f"Marked {len(read_ids)} emails as read.")
+    return failed
 
 def main():
-    """Main function to check emails, read threads, and create draft replies."""
-    service = authenticate_gmail()
+    """Main function to wait for new emails, read threads, and create draft replies."""
+    service, credentials = authenticate_gmail()
+    notifications = start_notification_listener()
+    history_id = watch_mailbox(service)
+    watched_at = time.time()
 
+    # Handle anything that was already unread before the watch started
+    print("Checking for existing unread emails...")
+    retry = process_messages(service, credentials, get_unread_emails(service))
+
+    backoff = INITIAL_BACKOFF
     while True:
         try:
-            print("Checking for new unread emails...")
-            messages = get_unread_emails(service)
-            if not messages:
-                print("No new unread emails found.")
-            else:
-                print(f"Found {len(messages)} unread emails.")
-                for message in messages:
-                    msg_id = message['id']
-                    thread_id = message['threadId']
-                    print(f"Processing email with message ID: {msg_id} in thread: {thread_id}")
-                    
-                    # Get thread details
-                    thread_details, latest_message_id = get_thread_details(service, thread_id)
-                    if not thread_details:
-                        print(f"No details found for thread {thread_id}. Skipping.")
-                        continue
-                    
-                    # Use details from the latest message for the reply
-                    latest_message = thread_details[-1]
-                    to_email = latest_message['from']
-                    subject = latest_message['subject']
-                    
-                    print(f"Thread contains {len(thread_details)} messages. Latest from: {to_email}, Subject: {subject}")
-                    
-                    # Create draft reply
-                    draft = create_draft_reply(service, to_email, subject, thread_id, latest_message_id, thread_details)
-                    print(f"Draft created for thread {thread_id}. Draft ID: {draft['id']}")
-                    
-                    # Mark the specific email as read
-                    mark_email_as_read(service, msg_id)
-                    print(f"Marked email {msg_id} as read.")
+            # Renew the watch before Gmail lets it expire
+            if time.time() - watched_at >= WATCH_RENEW_SECONDS:
+                watch_mailbox(service)
+                watched_at = time.time()
             
-            # Wait before checking again
-            time.sleep(60)  # Check every 60 seconds
+            try:
+                # Block until Gmail publishes a mailbox change
+                notifications.get(timeout=NOTIFICATION_TIMEOUT)
+                notified = True
+            except queue.Empty:
+                notified = False
+            # One history.list call covers every notification queued so far
+            while not notifications.empty():
+                notifications.get_nowait()
+            
+            if notified:
+                print("Fetching new emails since last notification...")
+                try:
+                    messages, new_history_id = get_new_unread_emails(service, history_id)
+                except HttpError as e:
+                    if e.resp.status != 404:
+                        raise
+                    # History too old to replay; resync from the full unread list
+                    new_history_id = watch_mailbox(service)
+                    watched_at = time.time()
+                    messages = get_unread_emails(service)
+            else:
+                # No notification; rescan the unread list in case one was lost or a pass failed
+                print("No notification received. Checking all unread emails...")
+                new_history_id = get_history_id(service)
+                messages = get_unread_emails(service)
+            # Retry earlier failures alongside the new messages, once each
+            messages = list({message['id']: message for message in retry + messages}.values())
+            retry = process_messages(service, credentials, messages)
+            # Advance only once the pass went through, so a failed pass is replayed
+            history_id = new_history_id
+            backoff = INITIAL_BACKOFF
         except Exception as e:
             print(f"An error occurred: {e}")
-            time.sleep(60)  # Wait before retrying on error
+            backoff = min(backoff * 2, MAX_BACKOFF)
+            delay = backoff
+            if isinstance(e, HttpError) and e.resp.status == 429:
+                # Rate limited; wait at least as long as Gmail asks
+                retry_after = e.resp.get('retry-after', '')
+                if retry_after.isdigit():
+                    delay = max(delay, int(retry_after))
+            print(f"Retrying in {delay} seconds...")
+            time.sleep(delay)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
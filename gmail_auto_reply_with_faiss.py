@@ -1,23 +1,26 @@
-import os
 import re
 import time
 import time
 import base64
-import faiss
-import numpy as np
-from email.mime.text import MIMEText
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from google.auth.transport.requests import Request
+import queue
+import shelve
+from email.utils import parseaddr
+from googleapiclient.errors import HttpError
 from google.auth.transport.requests import requests
-from sentence_transformers import SentenceTransformer
+from gmail_client import (NOTIFICATION_TIMEOUT, WATCH_RENEW_SECONDS, authenticate_gmail, encode_header,
+                          execute_batch, get_history_id, get_new_unread_emails, get_threads, get_unread_emails,
+                          mark_emails_as_read, start_notification_listener, watch_mailbox)
+from template_selector import select_templates
 
-# Gmail API scope for reading emails and creating drafts
-SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
+# Error backoff doubles from INITIAL_BACKOFF up to MAX_BACKOFF seconds
+INITIAL_BACKOFF = 1.0
+MAX_BACKOFF = 300
 
-# Initialize the sentence transformer model for embeddings
-model = SentenceTransformer('all-MiniLM-L6-v2')
+# Message IDs that already have a draft, persisted between restarts
+PROCESSED_DB = 'gmail_processed_messages'  # One per script; shelve files can't be shared between processes
+
+# Thread text passed to the embedder; comfortably more than its 256-token window
+MAX_THREAD_CHARS = 2048
 
 # Define email templates with {sender_name} placeholder
 EMAIL_TEMPLATES = [
@@ -49,65 +52,26 @@ Best regards,
     """,  # Template 3: General reply
 ]
 
-# Create FAISS index and add template embeddings
-def initialize_faiss_index(templates):
-    # Convert templates to embeddings (strip placeholders for cleaner embeddings)
-    clean_templates = [re.sub(r'{sender_name}', '', template) for template in templates]
-    template_embeddings = model.encode(clean_templates)
-    # Create a FAISS index (using L2 distance)
-    dimension = template_embeddings.shape[1]  # Embedding dimension
-    index = faiss.IndexFlatL2(dimension)
-    # Add embeddings to the index
-    index.add(template_embeddings)
-    return index, template_embeddings
-
-# Initialize FAISS index at startup
-faiss_index, template_embeddings = initialize_faiss_index(EMAIL_TEMPLATES)
-
-def authenticate_gmail():
-    """Authenticate with Gmail API and return the service object."""
-    creds = None
-    if os.path.exists('token.json'):
-        creds = Credentials.from_authorized_user_file('token.json', SCOPES)
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file(
-                'credentials.json', SCOPES)
-            creds = flow.run_local_server(port=0)
-        with open('token.json', 'w') as token:
-            token.write(creds.to_json())
-    
-    return build('gmail', 'v1', credentials=creds)
+# Embed templates without placeholders for cleaner embeddings
+CLEAN_TEMPLATES = tuple(re.sub(r'{sender_name}', '', template) for template in EMAIL_TEMPLATES)
 
-def get_unread_emails(service):
-    """Retrieve unread emails from the inbox."""
-    results = service.users().messages().list(userId='me', labelIds=['INBOX'], q='is:unread').execute()
-    messages = results.get('messages', [])
-    return messages
-
-def get_thread_details(service, thread_id):
-    """Get all messages in a thread and extract details."""
-    thread = service.users().threads().get(userId='me', id=thread_id).execute()
+def get_thread_details(thread):
+    """Extract details from all messages in a fetched thread."""
     messages = thread.get('messages', [])
     
     thread_details = []
-    thread_content = ""  # To store concatenated content for context analysis
+    body_parts = []  # Message bodies, joined once for context analysis
     for msg in messages:
-        headers = msg['payload']['headers']
-        subject = next((header['value'] for header in headers if header['name'] == 'Subject'), '')
-        from_email = next((header['value'] for header in headers if header['name'] == 'From'), '')
-        message_id = next((header['value'] for header in headers if header['name'] == 'Message-ID'), '')
-        date = next((header['value'] for header in headers if header['name'] == 'Date'), '')
+        # Index headers once instead of scanning the list for every field
+        headers = {header['name']: header['value'] for header in msg['payload']['headers']}
+        subject = headers.get('Subject', '')
+        from_email = headers.get('From', '')
+        message_id = headers.get('Message-ID', '')
+        date = headers.get('Date', '')
         
         # Extract sender's name from 'From' header
-        sender_name = ''
-        match = re.match(r'(.+?)\s*<\S+@[\S\.]+>', from_email)
-        if match:
-            sender_name = match.group(1).strip('"').strip()
-        else:
-            sender_name = from_email.split('@')[0]  # Fallback to email username if no name is found
+        name, address = parseaddr(from_email)
+        sender_name = name or address.split('@')[0]  # Fallback to email username if no name is found
         
         # Extract message body (simplified, assumes text/plain part)
         body = ''
@@ -127,95 +91,179 @@ def get_thread_details(service, thread_id):
             'message_id': message_id,
             'date': date
         })
-        thread_content += body + " "  # Concatenate body for context
+        body_parts.append(body)
     
-    return thread_details, messages[-1]['id'], thread_content.strip()
-
-def select_template(thread_content):
-    """Select the most relevant email template using FAISS."""
-    # Convert thread content to embedding
-    thread_embedding = model.encode([thread_content])
-    # Search FAISS index for the closest template
-    distances, indices = faiss_index.search(thread_embedding, 1)  # Get top 1 match
-    best_template_idx = indices[0][0]
-    return EMAIL_TEMPLATES[best_template_idx]
+    # The encoder truncates to MAX_SEQ_LENGTH tokens anyway; don't tokenize text it will drop
+    return thread_details, messages[-1]['id'], " ".join(body_parts).strip()[:MAX_THREAD_CHARS]
 
 def create_draft_reply(service, to_email, subject, thread_id, latest_message_id, thread_details, reply_content, sender_name):
-    """Create a draft reply for the email thread."""
+    """Build the request creating a draft reply for the email thread."""
     # Use the selected template as the reply content, replacing {sender_name}
     reply_content = reply_content.format(sender_name=sender_name)
     latest_message = thread_details[-1]
-    message = MIMEText(reply_content + f"\n\n> On {latest_message['date']}, {latest_message['from']} wrote:\n> {latest_message['body']}")
-    message['to'] = to_email
-    message['subject'] = f"Re: {subject}"
-    message['In-Reply-To'] = latest_message_id
-    message['References'] = latest_message_id
+    reply_content += f"\n\n> On {latest_message['date']}, {latest_message['from']} wrote:\n> {latest_message['body']}"
+    # Assemble the RFC 822 message directly instead of running the email package generator
+    raw = (
+        f"To: {encode_header(to_email)}\r\n"
+        f"Subject: {encode_header(f'Re: {subject}')}\r\n"
+        f"In-Reply-To: {latest_message_id}\r\n"
+        f"References: {latest_message_id}\r\n"
+        "MIME-Version: 1.0\r\n"
+        "Content-Type: text/plain; charset=utf-8\r\n"
+        "Content-Transfer-Encoding: 8bit\r\n"
+        "\r\n"
+        f"{reply_content}"
+    ).encode('utf-8')
 
-    raw_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
+    raw_message = base64.urlsafe_b64encode(raw).decode()
     draft = {
         'message': {
             'raw': raw_message,
             'threadId': thread_id
         }
     }
-    return service.users().drafts().create(userId='me', body=draft).execute()
+    return service.users().drafts().create(userId='me', body=draft)
 
-def mark_email_as_read(service, msg_id):
-    """Mark an email as read."""
-    service.users().messages().modify(
-        userId='me',
-        id=msg_id,
-        body={'removeLabelIds': ['UNREAD']}
-    ).execute()
+def process_messages(service, credentials, messages, processed):
+    """Create draft replies for unread messages, mark them as read and return those to retry."""
+    if not messages:
+        print("No new unread emails found.")
+        return []
+    print(f"Found {len(messages)} unread emails.")
+    # Messages drafted on an earlier pass only still need marking as read
+    read_ids = [message['id'] for message in messages if message['id'] in processed]
+    if read_ids:
+        print(f"Skipping {len(read_ids)} emails that already have drafts.")
+        messages = [message for message in messages if message['id'] not in processed]
+    failed = []  # Messages that still need a draft
+    # Fetch every referenced thread up front in batched requests
+    threads = get_threads(service, credentials, list(dict.fromkeys(message['threadId'] for message in messages)))
+    candidates = []  # (msg_id, thread_id, thread_history_id, thread_details, latest_message_id, thread_content)
+    for message in messages:
+        msg_id = message['id']
+        thread_id = message['threadId']
+        print(f"Processing email with message ID: {msg_id} in thread: {thread_id}")
+        
+        thread = threads.get(thread_id)
+        if not thread:
+            print(f"Could not fetch thread {thread_id}. Will retry.")
+            failed.append(message)
+            continue
+        
+        # Get thread details and content
+        thread_details, latest_message_id, thread_content = get_thread_details(thread)
+        if not thread_details:
+            print(f"No details found for thread {thread_id}. Skipping.")
+            continue
+        
+        # Use details from the latest message for the reply
+        latest_message = thread_details[-1]
+        to_email = latest_message['from']
+        subject = latest_message['subject']
+        sender_name = latest_message['sender_name']  # Get sender's name
+        
+        print(f"Thread contains {len(thread_details)} messages. Latest from: {to_email}, Name: {sender_name}, Subject: {subject}")
+        candidates.append((msg_id, thread_id, thread['historyId'], thread_details, latest_message_id, thread_content))
+    
+    # Keyword rules first, then one batched encode for whatever they leave undecided
+    template_indices = select_templates([candidate[-1] for candidate in candidates],
+                                        [candidate[-3][-1]['body'] for candidate in candidates],
+                                        CLEAN_TEMPLATES)
+    draft_requests = []
+    pending = []  # (msg_id, thread_id, thread_history_id, template_idx) for each queued draft
+    for (msg_id, thread_id, thread_history_id, thread_details, latest_message_id, _), template_idx in zip(candidates, template_indices):
+        latest_message = thread_details[-1]
+        reply_content = EMAIL_TEMPLATES[template_idx]
+        print(f"Selected template for thread {thread_id}: {reply_content.splitlines()[1]}...")  # Print first line of template for logging
+        
+        # Queue draft reply
+        draft_requests.append(create_draft_reply(service, latest_message['from'], latest_message['subject'], thread_id, latest_message_id, thread_details, reply_content, latest_message['sender_name']))
+        pending.append((msg_id, thread_id, thread_history_id, template_idx))
+    
+    # Create all drafts in batched requests
+    drafts = execute_batch(service, credentials, draft_requests)
+    for (msg_id, thread_id, thread_history_id, template_idx), draft in zip(pending, drafts):
+        if draft:
+            print(f"Draft created for thread {thread_id}. Draft ID: {draft['id']}")
+            processed[msg_id] = (thread_history_id, template_idx)
+            read_ids.append(msg_id)
+        else:
+            failed.append({'id': msg_id, 'threadId': thread_id})
+    
+    # Mark the emails that got a draft as read
+    if read_ids:
+        mark_emails_as_read(service, read_ids)
+        print(f"Marked {len(read_ids)} emails as read.")
+    return failed
 
 def main():
-    """Main function to check emails, read threads, and create draft replies."""
-    service = authenticate_gmail()
-
-    while True:
-        try:
-            print("Checking for new unread emails...")
-            messages = get_unread_emails(service)
-            if not messages:
-                print("No new unread emails found.")
-            else:
-                print(f"Found {len(messages)} unread emails.")
-                for message in messages:
-                    msg_id = message['id']
-                    thread_id = message['threadId']
-                    print(f"Processing email with message ID: {msg_id} in thread: {thread_id}")
-                    
-                    # Get thread details and content
-                    thread_details, latest_message_id, thread_content = get_thread_details(service, thread_id)
-                    if not thread_details:
-                        print(f"No details found for thread {thread_id}. Skipping.")
-                        continue
-                    
-                    # Use details from the latest message for the reply
-                    latest_message = thread_details[-1]
-                    to_email = latest_message['from']
-                    subject = latest_message['subject']
-                    sender_name = latest_message['sender_name']  # Get sender's name
-                    
-                    print(f"Thread contains {len(thread_details)} messages. Latest from: {to_email}, Name: {sender_name}, Subject: {subject}")
-                    
-                    # Select the most relevant template
-                    reply_content = select_template(thread_content)
-                    print(f"Selected template: {reply_content.splitlines()[1]}...")  # Print first line of template for logging
-                    
-                    # Create draft reply
-                    draft = create_draft_reply(service, to_email, subject, thread_id, latest_message_id, thread_details, reply_content, sender_name)
-                    print(f"Draft created for thread {thread_id}. Draft ID: {draft['id']}")
-                    
-                    # Mark the specific email as read
-                    mark_email_as_read(service, msg_id)
-                    print(f"Marked email {msg_id} as read.")
+    """Main function to wait for new emails, read threads, and create draft replies."""
+    service, credentials = authenticate_gmail()
+    # Drafted message IDs survive restarts so a thread is never drafted twice
+    processed = shelve.open(PROCESSED_DB)
+    try:
+        notifications = start_notification_listener()
+        history_id = watch_mailbox(service)
+        watched_at = time.time()
+
+        # Handle anything that was already unread before the watch started
+        print("Checking for existing unread emails...")
+        retry = process_messages(service, credentials, get_unread_emails(service), processed)
+
+        backoff = INITIAL_BACKOFF
+        while True:
+            try:
+                # Renew the watch before Gmail lets it expire
+                if time.time() - watched_at >= WATCH_RENEW_SECONDS:
+                    watch_mailbox(service)
+                    watched_at = time.time()
+            
+                try:
+                    # Block until Gmail publishes a mailbox change
+                    notifications.get(timeout=NOTIFICATION_TIMEOUT)
+                    notified = True
+                except queue.Empty:
+                    notified = False
+                # One history.list call covers every notification queued so far
+                while not notifications.empty():
+                    notifications.get_nowait()
             
-            # Wait before checking again
-            time.sleep(60)  # Check every 60 seconds
-        except Exception as e:
-            print(f"An error occurred: {e}")
-            time.sleep(60)  # Wait before retrying on error
+                if notified:
+                    print("Fetching new emails since last notification...")
+                    try:
+                        messages, new_history_id = get_new_unread_emails(service, history_id)
+                    except HttpError as e:
+                        if e.resp.status != 404:
+                            raise
+                        # History too old to replay; resync from the full unread list
+                        new_history_id = watch_mailbox(service)
+                        watched_at = time.time()
+                        messages = get_unread_emails(service)
+                else:
+                    # No notification; rescan the unread list in case one was lost or a pass failed
+                    print("No notification received. Checking all unread emails...")
+                    new_history_id = get_history_id(service)
+                    messages = get_unread_emails(service)
+                # Retry earlier failures alongside the new messages, once each
+                messages = list({message['id']: message for message in retry + messages}.values())
+                retry = process_messages(service, credentials, messages, processed)
+                # Advance only once the pass went through, so a failed pass is replayed
+                history_id = new_history_id
+                processed.sync()
+                backoff = INITIAL_BACKOFF
+            except Exception as e:
+                print(f"An error occurred: {e}")
+                backoff = min(backoff * 2, MAX_BACKOFF)
+                delay = backoff
+                if isinstance(e, HttpError) and e.resp.status == 429:
+                    # Rate limited; wait at least as long as Gmail asks
+                    retry_after = e.resp.get('retry-after', '')
+                    if retry_after.isdigit():
+                        delay = max(delay, int(retry_after))
+                print(f"Retrying in {delay} seconds...")
+                time.sleep(delay)
+    finally:
+        processed.close()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,156 @@
+import os
+import json
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from email.header import Header
+from google.oauth2.credentials import Credentials
+from google_auth_oauthlib.flow import InstalledAppFlow
+import httplib2
+from googleapiclient.discovery import build
+from google.cloud import pubsub_v1
+from google.auth.transport.requests import Request
+from google_auth_httplib2 import AuthorizedHttp
+from token_store import save_token
+
+# Gmail API scope for reading emails and creating drafts
+SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
+
+# Gmail accepts at most 100 calls per batch HTTP request
+BATCH_SIZE = 100
+# Batch requests sent in parallel when there are more than BATCH_SIZE calls
+BATCH_WORKERS = 8
+
+# Cloud Pub/Sub topic Gmail publishes mailbox changes to, and the subscription we listen on
+PUBSUB_TOPIC = 'projects/{project_id}/topics/gmail'  # Replace {project_id} with your GCP project ID
+PUBSUB_SUBSCRIPTION = 'projects/{project_id}/subscriptions/gmail'
+# Gmail watches expire after 7 days; renew daily
+WATCH_RENEW_SECONDS = 24 * 60 * 60
+# Check history even without a notification this often, in case the subscription has stalled
+NOTIFICATION_TIMEOUT = 5 * 60
+# Wait before restarting a streaming pull that stopped
+RESUBSCRIBE_DELAY = 30
+
+def authenticate_gmail():
+    """Authenticate with Gmail API and return the service object and its credentials."""
+    creds = None
+    if os.path.exists('token.json'):
+        creds = Credentials.from_authorized_user_file('token.json', SCOPES)
+    if not creds or not creds.valid:
+        if creds and creds.expired and creds.refresh_token:
+            creds.refresh(Request())
+        else:
+            flow = InstalledAppFlow.from_client_secrets_file(
+                'credentials.json', SCOPES)
+            creds = flow.run_local_server(port=0)
+        save_token(creds)
+    
+    return build('gmail', 'v1', credentials=creds), creds
+
+def watch_mailbox(service):
+    """Ask Gmail to publish INBOX changes to Pub/Sub and return the current historyId."""
+    response = service.users().watch(
+        userId='me',
+        body={'labelIds': ['INBOX'], 'topicName': PUBSUB_TOPIC}
+    ).execute(num_retries=5)
+    return response['historyId']
+
+def start_notification_listener():
+    """Subscribe to Gmail push notifications and return a queue of historyIds."""
+    notifications = queue.Queue()
+
+    def on_message(message):
+        notifications.put(json.loads(message.data)['historyId'])
+        message.ack()
+
+    subscriber = pubsub_v1.SubscriberClient()
+
+    def subscribe():
+        streaming_pull = subscriber.subscribe(PUBSUB_SUBSCRIPTION, callback=on_message)
+        streaming_pull.add_done_callback(on_done)
+
+    def on_done(streaming_pull):
+        # The pull ends on a bad subscription, missing permissions or a lost connection
+        if streaming_pull.cancelled():
+            return
+        print(f"Pub/Sub streaming pull stopped: {streaming_pull.exception()}")
+        print(f"Resubscribing in {RESUBSCRIBE_DELAY} seconds...")
+        threading.Timer(RESUBSCRIBE_DELAY, subscribe).start()
+
+    subscribe()
+    return notifications
+
+def get_new_unread_emails(service, start_history_id):
+    """Retrieve unread inbox emails added since start_history_id, plus the new historyId."""
+    messages = []
+    history_id = start_history_id
+    page_token = None
+    while True:
+        results = service.users().history().list(
+            userId='me', startHistoryId=start_history_id, labelId='INBOX',
+            historyTypes=['messageAdded'], pageToken=page_token).execute(num_retries=5)
+        for record in results.get('history', []):
+            for added in record.get('messagesAdded', []):
+                message = added['message']
+                if 'UNREAD' in message.get('labelIds', []):
+                    messages.append({'id': message['id'], 'threadId': message['threadId']})
+        history_id = results.get('historyId', history_id)
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return messages, history_id
+
+def get_history_id(service):
+    """Return the mailbox's current historyId."""
+    return service.users().getProfile(userId='me').execute(num_retries=5)['historyId']
+
+def get_unread_emails(service):
+    """Retrieve unread emails from the inbox."""
+    results = service.users().messages().list(userId='me', labelIds=['INBOX'], q='is:unread').execute(num_retries=5)
+    messages = results.get('messages', [])
+    return messages
+
+def execute_batch(service, credentials, api_requests):
+    """Execute API requests in concurrent batches and return their responses in order."""
+    responses = [None] * len(api_requests)
+
+    def collect(request_id, response, exception):
+        if exception is not None:
+            print(f"Batched request {request_id} failed: {exception}")
+        else:
+            responses[int(request_id)] = response
+
+    def execute_chunk(start, http=None):
+        batch = service.new_batch_http_request(callback=collect)
+        for i, api_request in enumerate(api_requests[start:start + BATCH_SIZE], start):
+            batch.add(api_request, request_id=str(i))
+        batch.execute(http=http)
+
+    if len(api_requests) <= BATCH_SIZE:
+        # One chunk: send it inline over the service's own kept-alive connection
+        if api_requests:
+            execute_chunk(0)
+        return responses
+    
+    def execute_chunk_parallel(start):
+        # httplib2 connections are not thread-safe, so each parallel chunk sends over its own
+        execute_chunk(start, http=AuthorizedHttp(credentials, http=httplib2.Http()))
+
+    with ThreadPoolExecutor(max_workers=BATCH_WORKERS) as executor:
+        list(executor.map(execute_chunk_parallel, range(0, len(api_requests), BATCH_SIZE)))
+    return responses
+
+def get_threads(service, credentials, thread_ids):
+    """Fetch several threads in batched requests, keyed by thread ID."""
+    api_requests = [service.users().threads().get(userId='me', id=thread_id) for thread_id in thread_ids]
+    return dict(zip(thread_ids, execute_batch(service, credentials, api_requests)))
+
+def encode_header(value):
+    """RFC 2047-encode a header value only when it is not plain ASCII."""
+    return value if value.isascii() else Header(value, 'utf-8').encode()
+
+def mark_emails_as_read(service, msg_ids):
+    """Mark several emails as read with a single batchModify call."""
+    service.users().messages().batchModify(
+        userId='me',
+        body={'ids': msg_ids, 'removeLabelIds': ['UNREAD']}
+    ).execute(num_retries=5)
@@ -0,0 +1,46 @@
+import re
+import hashlib
+from collections import OrderedDict
+from embedder import encode, get_template_embeddings
+
+# Template choices keyed by a blake2b digest of the thread content
+TEMPLATE_CACHE_SIZE = 1024
+_template_cache = OrderedDict()
+
+# Keyword rules that settle clear-cut emails without running the encoder
+_RULES = [
+    (re.compile(r'\b(meeting|schedule|call)\b', re.I), 0),  # Meeting request
+    (re.compile(r'\b(support|ticket|issue|bug)\b', re.I), 1),  # Support inquiry
+]
+
+def match_rules(text):
+    """Return the template index picked by the keyword rules, or None if they don't settle it."""
+    matches = {template_idx for pattern, template_idx in _RULES if pattern.search(text)}
+    # Text hitting several rules is ambiguous; leave it to the embeddings
+    return matches.pop() if len(matches) == 1 else None
+
+def select_templates(thread_contents, latest_bodies, templates):
+    """Select the index of the most relevant of templates (a tuple) for each thread, by keyword rules or cosine similarity."""
+    import numpy as np
+    template_indices = [match_rules(latest_body) for latest_body in latest_bodies]
+    # Only threads the rules could not classify need an embedding
+    unmatched = [i for i, template_idx in enumerate(template_indices) if template_idx is None]
+    # Identical thread content always picks the same template
+    keys = [hashlib.blake2b(thread_contents[i].encode()).digest() for i in unmatched]
+    uncached = {}
+    for key, i in zip(keys, unmatched):
+        if key not in _template_cache:
+            uncached[key] = thread_contents[i]
+    if uncached:
+        # Convert all new thread contents to normalized embeddings in one pass
+        thread_embeddings = encode(list(uncached.values()))
+        # A single matrix product scores every thread against every template
+        best_template_indices = np.argmax(thread_embeddings @ get_template_embeddings(templates).T, axis=1)
+        for key, best_template_idx in zip(uncached, best_template_indices):
+            _template_cache[key] = int(best_template_idx)
+    for key, i in zip(keys, unmatched):
+        _template_cache.move_to_end(key)
+        template_indices[i] = _template_cache[key]
+    while len(_template_cache) > TEMPLATE_CACHE_SIZE:
+        _template_cache.popitem(last=False)
+    return template_indices
@@ -0,0 +1,18 @@
+import os
+import fcntl
+import tempfile
+
+def save_token(creds, path='token.json'):
+    """Atomically write credentials to path, skipping the write if they haven't changed."""
+    token_json = creds.to_json()
+    # Serialize writers so concurrent runs can't interleave their updates
+    with open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.exists(path):
+            with open(path) as token:
+                if token.read() == token_json:
+                    return
+        # Write a temp file beside the token and rename it over, so readers never see a partial file
+        with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(os.path.abspath(path)), delete=False) as tmp:
+            tmp.write(token_json)
+        os.replace(tmp.name, path)
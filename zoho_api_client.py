@@ -1,5 +1,6 @@
-import requests
-import json
+import asyncio
+import httpx
+import orjson
 
 class ZohoAPIClient:
     def __init__(self, credentials):
@@ -9,29 +10,35 @@ class ZohoAPIClient:
             "Authorization": f"Zoho-oauthtoken {self.access_token}",
             "Content-Type": "application/json"
         }
+        self.limits = httpx.Limits(max_keepalive_connections=10)
+        # Shared client keeps the TLS connection alive between calls (requires httpx[http2])
+        self._client = httpx.Client(http2=True, base_url=self.base_url, headers=self.headers, limits=self.limits)
+        # Thread fetches run on one long-lived loop and async client, so they also keep the connection between polls
+        self._loop = asyncio.new_event_loop()
+        self._async_client = httpx.AsyncClient(http2=True, base_url=self.base_url, headers=self.headers, limits=self.limits)
 
     def list_messages(self, folder, unread):
-        url = f"{self.base_url}?folder={folder}&unread={unread}"
-        response = requests.get(url, headers=self.headers)
-        return response.json() if response.status_code == 200 else {}
+        response = self._client.get(self.base_url, params={"folder": folder, "unread": str(unread)})
+        return orjson.loads(response.content) if response.status_code == 200 else {}
 
-    def get_thread(self, thread_id):
-        url = f"{self.base_url}/{thread_id}"
-        response = requests.get(url, headers=self.headers)
-        return response.json() if response.status_code == 200 else {}
+    def get_threads(self, thread_ids):
+        return self._loop.run_until_complete(self._get_threads(thread_ids))
+
+    async def _get_threads(self, thread_ids):
+        # Fetch threads concurrently, multiplexed over one HTTP/2 connection
+        responses = await asyncio.gather(*(self._async_client.get(str(thread_id)) for thread_id in thread_ids))
+        return [orjson.loads(response.content) if response.status_code == 200 else {} for response in responses]
 
     def create_draft(self, to_email, subject, raw_message, thread_id):
-        url = f"{self.base_url}/drafts"
         payload = {
             "to": to_email,
             "subject": subject,
             "content": raw_message,
             "threadId": thread_id
         }
-        response = requests.post(url, headers=self.headers, data=json.dumps(payload))
-        return response.json() if response.status_code == 201 else {}
+        response = self._client.post("drafts", content=orjson.dumps(payload))
+        return orjson.loads(response.content) if response.status_code == 201 else {}
 
     def update_message(self, msg_id, updates):
-        url = f"{self.base_url}/{msg_id}"
-        response = requests.patch(url, headers=self.headers, data=json.dumps(updates))
-        return response.status_code == 200
\ No newline at end of file
+        response = self._client.patch(str(msg_id), content=orjson.dumps(updates))
+        return response.status_code == 200
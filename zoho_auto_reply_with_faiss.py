@@ -1,20 +1,27 @@
 import os
 import time
 import base64
-import faiss
-import numpy as np
+import shelve
 from email.mime.text import MIMEText
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request  # Added missing import
 from zoho_api_client import ZohoAPIClient  # Custom client for Zoho Mail API
-from sentence_transformers import SentenceTransformer
+from template_selector import select_templates
+from token_store import save_token
 
 # Zoho Mail API scope
 SCOPES = ['ZohoMail.messages.ALL']
 
-# Initialize the sentence transformer model for embeddings
-model = SentenceTransformer('all-MiniLM-L6-v2')
+# Message IDs that already have a draft, persisted between restarts
+PROCESSED_DB = 'zoho_processed_messages'  # One per script; shelve files can't be shared between processes
+
+# Error backoff doubles from INITIAL_BACKOFF up to MAX_BACKOFF seconds
+INITIAL_BACKOFF = 1.0
+MAX_BACKOFF = 300
+
+# Thread text passed to the embedder; comfortably more than its 256-token window
+MAX_THREAD_CHARS = 2048
 
 # Define email templates
 EMAIL_TEMPLATES = [
@@ -40,17 +47,6 @@ Best regards,
     """,  # Template 3: General reply
 ]
 
-# Create FAISS index and add template embeddings
-def initialize_faiss_index(templates):
-    template_embeddings = model.encode(templates)
-    dimension = template_embeddings.shape[1]
-    index = faiss.IndexFlatL2(dimension)
-    index.add(template_embeddings)
-    return index, template_embeddings
-
-# Initialize FAISS index at startup
-faiss_index, template_embeddings = initialize_faiss_index(EMAIL_TEMPLATES)
-
 def authenticate_zoho():
     """Authenticate with Zoho Mail API and return the service object."""
     creds = None
@@ -63,8 +59,7 @@ def authenticate_zoho():
             flow = InstalledAppFlow.from_client_secrets_file(
                 'zoho_credentials.json', SCOPES)
             creds = flow.run_local_server(port=8080)  # Fixed port for Zoho
-        with open('token.json', 'w') as token:
-            token.write(creds.to_json())
+        save_token(creds)
     
     return ZohoAPIClient(creds)
 
@@ -73,13 +68,14 @@ def get_unread_emails(service):
     results = service.list_messages(folder='Inbox', unread=True)
     return results.get('data', []) if results else []
 
-def get_thread_details(service, thread_id):
-    """Get all messages in a thread and extract details."""
-    thread = service.get_thread(thread_id)
+def get_thread_details(thread):
+    """Extract details from all messages in a fetched thread."""
     messages = thread.get('messages', [])
+    if not messages:
+        return [], None, ""
     
     thread_details = []
-    thread_content = ""
+    body_parts = []
     for msg in messages:
         headers = msg.get('headers', {})
         subject = headers.get('subject', '')
@@ -95,16 +91,10 @@ def get_thread_details(service, thread_id):
             'message_id': message_id,
             'date': date
         })
-        thread_content += body + " "
+        body_parts.append(body)
     
-    return thread_details, messages[-1]['message_id'], thread_content.strip()
-
-def select_template(thread_content):
-    """Select the most relevant email template using FAISS."""
-    thread_embedding = model.encode([thread_content])
-    distances, indices = faiss_index.search(thread_embedding, 1)
-    best_template_idx = indices[0][0]
-    return EMAIL_TEMPLATES[best_template_idx]
+    # The encoder truncates to MAX_SEQ_LENGTH tokens anyway; don't tokenize text it will drop
+    return thread_details, messages[-1]['message_id'], " ".join(body_parts).strip()[:MAX_THREAD_CHARS]
 
 def create_draft_reply(service, to_email, subject, thread_id, latest_message_id, thread_details, reply_content):
     """Create a draft reply for the email thread."""
@@ -126,44 +116,73 @@ def mark_email_as_read(service, msg_id):
 def main():
     """Main function to check emails, read threads, and create draft replies."""
     service = authenticate_zoho()
-
-    while True:
-        try:
-            print("Checking for new unread emails...")
-            messages = get_unread_emails(service)
-            if not messages:
-                print("No new unread emails found.")
-            else:
-                print(f"Found {len(messages)} unread emails.")
-                for message in messages:
-                    msg_id = message['message_id']
-                    thread_id = message.get('thread_id', msg_id)  # Zoho may use message_id as thread_id
-                    print(f"Processing email with message ID: {msg_id} in thread: {thread_id}")
+    # Drafted message IDs survive restarts so a thread is never drafted twice
+    processed = shelve.open(PROCESSED_DB)
+    try:
+        backoff = INITIAL_BACKOFF
+        while True:
+            try:
+                print("Checking for new unread emails...")
+                messages = get_unread_emails(service)
+                if not messages:
+                    print("No new unread emails found.")
+                else:
+                    print(f"Found {len(messages)} unread emails.")
+                    # Fetch every thread still needing a draft concurrently
+                    thread_ids = list(dict.fromkeys(
+                        message.get('thread_id', message['message_id'])
+                        for message in messages if str(message['message_id']) not in processed))
+                    threads = dict(zip(thread_ids, service.get_threads(thread_ids)))
+                    candidates = []  # (msg_id, thread_id, thread_details, latest_message_id, thread_content)
+                    for message in messages:
+                        msg_id = message['message_id']
+                        thread_id = message.get('thread_id', msg_id)  # Zoho may use message_id as thread_id
+                        print(f"Processing email with message ID: {msg_id} in thread: {thread_id}")
                     
-                    thread_details, latest_message_id, thread_content = get_thread_details(service, thread_id)
-                    if not thread_details:
-                        print(f"No details found for thread {thread_id}. Skipping.")
-                        continue
+                        if str(msg_id) in processed:
+                            # Drafted on an earlier pass; only the mark-as-read is outstanding
+                            print(f"Draft already exists for email {msg_id}. Skipping.")
+                            mark_email_as_read(service, msg_id)
+                            continue
                     
-                    latest_message = thread_details[-1]
-                    to_email = latest_message['from']
-                    subject = latest_message['subject']
+                        thread_details, latest_message_id, thread_content = get_thread_details(threads[thread_id])
+                        if not thread_details:
+                            print(f"No details found for thread {thread_id}. Skipping.")
+                            continue
                     
-                    print(f"Thread contains {len(thread_details)} messages. Latest from: {to_email}, Subject: {subject}")
+                        latest_message = thread_details[-1]
+                        to_email = latest_message['from']
+                        subject = latest_message['subject']
                     
-                    reply_content = select_template(thread_content)
-                    print(f"Selected template: {reply_content.splitlines()[1]}...")
+                        print(f"Thread contains {len(thread_details)} messages. Latest from: {to_email}, Subject: {subject}")
+                        candidates.append((msg_id, thread_id, thread_details, latest_message_id, thread_content))
+                
+                    # Keyword rules first, then one batched encode for whatever they leave undecided
+                    template_indices = select_templates([candidate[-1] for candidate in candidates],
+                                                        [candidate[-3][-1]['body'] for candidate in candidates],
+                                                        tuple(EMAIL_TEMPLATES))
+                    for (msg_id, thread_id, thread_details, latest_message_id, _), template_idx in zip(candidates, template_indices):
+                        latest_message = thread_details[-1]
+                        reply_content = EMAIL_TEMPLATES[template_idx]
+                        print(f"Selected template for thread {thread_id}: {reply_content.splitlines()[1]}...")
                     
-                    draft = create_draft_reply(service, to_email, subject, thread_id, latest_message_id, thread_details, reply_content)
-                    print(f"Draft created for thread {thread_id}. Draft ID: {draft['id']}")
+                        draft = create_draft_reply(service, latest_message['from'], latest_message['subject'], thread_id, latest_message_id, thread_details, reply_content)
+                        print(f"Draft created for thread {thread_id}. Draft ID: {draft['id']}")
+                        processed[str(msg_id)] = (latest_message_id, template_idx)
                     
-                    mark_email_as_read(service, msg_id)
-                    print(f"Marked email {msg_id} as read.")
+                        mark_email_as_read(service, msg_id)
+                        print(f"Marked email {msg_id} as read.")
             
-            time.sleep(60)  # Check every 60 seconds
-        except Exception as e:
-            print(f"An error occurred: {e}")
-            time.sleep(60)
+                processed.sync()
+                backoff = INITIAL_BACKOFF
+                time.sleep(60)  # Check every 60 seconds
+            except Exception as e:
+                print(f"An error occurred: {e}")
+                backoff = min(backoff * 2, MAX_BACKOFF)
+                print(f"Retrying in {backoff} seconds...")
+                time.sleep(backoff)
+    finally:
+        processed.close()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
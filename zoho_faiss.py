@@ -1,22 +1,29 @@
 import imaplib
 import smtplib
 import email
+import email.policy
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from email.header import decode_header
+import re
 import time
+import hashlib
+from collections import OrderedDict, deque
 import logging
-from datetime import datetime
-import faiss
-import numpy as np
-from sentence_transformers import SentenceTransformer
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import embed_worker
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# Initialize the sentence transformer model for embeddings
-model = SentenceTransformer('all-MiniLM-L6-v2')
+# Longest body kept from an email; replies and template selection only need the start
+MAX_EXTRACTED_CHARS = 4096
+
+# Email bodies are embedded with the shared int8 ONNX MiniLM in a worker process (see embed_worker.py)
+MAX_BODY_CHARS = 512  # Cap outliers so one long email doesn't pad the whole batch
 
 # Define email templates
 EMAIL_TEMPLATES = [
@@ -42,16 +49,24 @@ Best regards,
     """,  # Template 3: General reply
 ]
 
-# Create FAISS index and add template embeddings
-def initialize_faiss_index(templates):
-    template_embeddings = model.encode(templates)
-    dimension = template_embeddings.shape[1]
-    index = faiss.IndexFlatL2(dimension)
-    index.add(template_embeddings)
-    return index, template_embeddings
+# Template choices keyed by a blake2b digest of the normalized body
+TEMPLATE_CACHE_SIZE = 4096
+_template_cache = OrderedDict()
+
+# Headers and body fetched for each new email; BODY.PEEK leaves \Seen to mark_as_read,
+# which sets it only once the draft is saved.
+# The MIME headers are included so the body can still be parsed into its parts.
+FETCH_ITEMS = ('(UID BODY.PEEK[HEADER.FIELDS (SUBJECT FROM MESSAGE-ID MIME-VERSION CONTENT-TYPE '
+               'CONTENT-TRANSFER-ENCODING)] BODY.PEEK[TEXT])')
+
+# LIST response line: (flags) "delimiter" name
+LIST_RESPONSE = re.compile(rb'\((?P<flags>[^)]*)\) (?:"[^"]*"|NIL) (?P<name>.+)')
+
+# Drafts saved in parallel; Zoho allows only a handful of concurrent IMAP sessions
+DRAFT_WORKERS = 5
 
-# Initialize FAISS index at startup
-faiss_index, template_embeddings = initialize_faiss_index(EMAIL_TEMPLATES)
+# Number of processed email IDs remembered to avoid duplicates
+SEEN_WINDOW = 10000
 
 class ZohoEmailProcessor:
     def __init__(self, email_address, password):
@@ -61,8 +76,48 @@ class ZohoEmailProcessor:
         self.smtp_server = "smtp.zoho.com"
         self.imap_port = 993
         self.smtp_port = 587
-        self.processed_emails = set()  # Track processed emails to avoid duplicates
+        # Bounded window of IDs drafted this run; drafted mail is also flagged \Seen on the server
+        self._seen_recent = deque(maxlen=SEEN_WINDOW)
+        self._seen_ids = set()
+        self._imap = None  # Long-lived IMAP connection reused across polling cycles
+        self._drafts_folder = None  # Discovered on first save
+        # Each draft worker keeps its own IMAP connection between cycles
+        self._draft_executor = ThreadPoolExecutor(max_workers=DRAFT_WORKERS)
+        self._draft_local = threading.local()
+        self._draft_connections = []
+        self._draft_lock = threading.Lock()
+        self._embed_pool = self._new_embed_pool()
         
+    def _new_embed_pool(self):
+        """Start the embedding worker process"""
+        # Inference runs in its own process so it never holds the GIL against the IMAP threads.
+        # Spawned rather than forked: by the first submit the draft threads and IMAP sockets exist.
+        return ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=embed_worker.load, initargs=(EMAIL_TEMPLATES,))
+    
+    def _classify(self, bodies):
+        """Classify bodies in the embedding worker, restarting it once if it has died"""
+        for attempt in range(2):
+            try:
+                return self._embed_pool.submit(embed_worker.classify, bodies).result()
+            except BrokenProcessPool as e:
+                # The worker failed to load the model or was killed; a dead pool never recovers
+                logger.error(f"Embedding worker died, restarting it: {e}")
+                self._embed_pool.shutdown(wait=False)
+                self._embed_pool = self._new_embed_pool()
+        return None
+    
+    def _seen(self, email_id):
+        """Check whether an email ID was processed recently"""
+        return email_id in self._seen_ids
+    
+    def _mark_seen(self, email_id):
+        """Remember an email ID, forgetting the oldest once the window is full"""
+        if len(self._seen_recent) == self._seen_recent.maxlen:
+            self._seen_ids.discard(self._seen_recent[0])
+        self._seen_recent.append(email_id)
+        self._seen_ids.add(email_id)
+    
     def connect_imap(self):
         """Connect to IMAP server"""
         try:
@@ -73,6 +128,47 @@ class ZohoEmailProcessor:
             logger.error(f"IMAP connection failed: {e}")
             return None
     
+    def _is_alive(self, mail):
+        """Check an IMAP connection with NOOP, which doubles as a heartbeat"""
+        try:
+            return mail.noop()[0] == 'OK'
+        except Exception as e:
+            logger.warning(f"IMAP connection lost, reconnecting: {e}")
+            return False
+    
+    def _get_imap(self):
+        """Return the shared IMAP connection, reconnecting if it has dropped"""
+        if self._imap is None or not self._is_alive(self._imap):
+            self._imap = self.connect_imap()
+        return self._imap
+    
+    def _get_draft_imap(self):
+        """Return the calling draft worker's IMAP connection, reconnecting if it has dropped"""
+        mail = getattr(self._draft_local, 'imap', None)
+        if mail is not None and self._is_alive(mail):
+            return mail
+        with self._draft_lock:
+            if mail is not None:
+                self._draft_connections.remove(mail)
+            mail = self._draft_local.imap = self.connect_imap()
+            if mail:
+                self._draft_connections.append(mail)
+        return mail
+    
+    def close_connections(self):
+        """Stop the workers and log out of every IMAP connection"""
+        self._draft_executor.shutdown(wait=True)
+        self._embed_pool.shutdown(wait=True)
+        for mail in [self._imap] + self._draft_connections:
+            if mail is None:
+                continue
+            try:
+                mail.logout()
+            except Exception:
+                pass
+        self._imap = None
+        self._draft_connections = []
+    
     def connect_smtp(self):
         """Connect to SMTP server"""
         try:
@@ -84,52 +180,41 @@ class ZohoEmailProcessor:
             logger.error(f"SMTP connection failed: {e}")
             return None
     
-    def decode_header_value(self, header):
-        """Decode email header"""
-        decoded = decode_header(header)
-        header_value = ""
-        for part, encoding in decoded:
-            if isinstance(part, bytes):
-                header_value += part.decode(encoding or 'utf-8')
-            else:
-                header_value += str(part)
-        return header_value
-    
     def get_unread_emails(self):
         """Fetch unread emails from inbox"""
-        mail = self.connect_imap()
+        mail = self._get_imap()
         if not mail:
             return []
         
         try:
             mail.select('INBOX')
-            # Search for unread emails
-            status, messages = mail.search(None, 'UNSEEN')
+            # Search for unread emails by UID
+            status, messages = mail.uid('SEARCH', None, 'UNSEEN')
             
             if status != 'OK':
                 logger.error("Failed to search for emails")
                 return []
             
-            email_ids = messages[0].split()
-            emails = []
+            email_ids = [uid for uid in messages[0].split() if not self._seen(uid.decode())]
+            if not email_ids:
+                return []
             
-            for email_id in email_ids:
-                if email_id.decode() in self.processed_emails:
-                    continue
-                    
-                # Fetch email
-                status, msg_data = mail.fetch(email_id, '(RFC822)')
-                if status != 'OK':
-                    continue
-                
+            # Fetch headers and bodies of every new email in one round-trip
+            status, msg_data = mail.uid('FETCH', b','.join(email_ids), FETCH_ITEMS)
+            if status != 'OK':
+                logger.error("Failed to fetch emails")
+                return []
+            
+            emails = []
+            for email_id, raw_email in self.parse_fetch_response(msg_data):
                 # Parse email
-                raw_email = msg_data[0][1]
-                email_message = email.message_from_bytes(raw_email)
+                # The default policy decodes RFC 2047 headers on access
+                email_message = email.message_from_bytes(raw_email, policy=email.policy.default)
                 
                 # Extract email details
-                subject = self.decode_header_value(email_message.get('Subject', ''))
-                sender = self.decode_header_value(email_message.get('From', ''))
-                message_id = email_message.get('Message-ID', '')
+                subject = str(email_message.get('Subject', ''))
+                sender = str(email_message.get('From', ''))
+                message_id = str(email_message.get('Message-ID', ''))
                 
                 # Get email body
                 body = self.extract_body(email_message)
@@ -143,61 +228,118 @@ class ZohoEmailProcessor:
                     'email_object': email_message
                 })
                 
-                self.processed_emails.add(email_id.decode())
                 logger.info(f"Found new email from {sender}: {subject}")
             
-            mail.close()
-            mail.logout()
             return emails
             
         except Exception as e:
             logger.error(f"Error fetching emails: {e}")
             return []
     
+    def parse_fetch_response(self, msg_data):
+        """Yield (uid, raw_email) pairs from a UID FETCH of headers and text"""
+        messages = []
+        current = None
+        for item in msg_data:
+            descriptor = item[0] if isinstance(item, tuple) else item
+            if not isinstance(descriptor, bytes):
+                continue
+            # A leading sequence number starts the next message's response
+            if re.match(rb'\d+ \(', descriptor):
+                current = {}
+                messages.append(current)
+            if current is None:
+                continue
+            uid = re.search(rb'UID (\d+)', descriptor)
+            if uid:
+                current['uid'] = uid.group(1)
+            if isinstance(item, tuple):
+                current['header' if b'HEADER' in descriptor else 'text'] = item[1]
+        for message in messages:
+            if 'uid' in message:
+                yield message['uid'], message.get('header', b'') + message.get('text', b'')
+    
+    def decode_part(self, part):
+        """Decode a MIME part's payload using its declared charset"""
+        payload = part.get_payload(decode=True) or b''
+        try:
+            return payload.decode(part.get_content_charset() or 'utf-8', 'replace')
+        except LookupError:  # Unknown charset name
+            return payload.decode('utf-8', 'replace')
+    
     def extract_body(self, email_message):
         """Extract email body text"""
         body = ""
-        
-        if email_message.is_multipart():
-            for part in email_message.walk():
-                content_type = part.get_content_type()
-                content_disposition = str(part.get("Content-Disposition"))
-                
-                if content_type == "text/plain" and "attachment" not in content_disposition:
-                    try:
-                        body = part.get_payload(decode=True).decode('utf-8')
-                        break
-                    except:
-                        continue
+        if not email_message.is_multipart():
+            body = self.decode_part(email_message)
         else:
-            try:
-                body = email_message.get_payload(decode=True).decode('utf-8')
-            except:
-                body = str(email_message.get_payload())
+            # Depth-first search that stops at the first inline text/plain part
+            stack = [email_message]
+            while stack:
+                part = stack.pop()
+                if part.is_multipart():
+                    stack.extend(reversed(part.get_payload()))  # Visit parts in document order
+                elif part.get_content_type() == "text/plain" and "attachment" not in str(part.get("Content-Disposition", "")):
+                    body = self.decode_part(part)
+                    break
         
-        return body
+        # Strip once here and bound what gets carried around per email
+        return body.strip()[:MAX_EXTRACTED_CHARS]
     
-    def select_template(self, email_body):
-        """Select the most relevant email template using FAISS."""
-        if not email_body.strip():  # Handle empty email body
-            logger.warning("Email body is empty, selecting default template")
-            return EMAIL_TEMPLATES[2]  # Default to general reply
+    def select_templates(self, email_bodies):
+        """Select the most relevant email template index for each body by cosine similarity."""
+        template_indices = [2] * len(email_bodies)  # Default to general reply
+        non_empty = [i for i, body in enumerate(email_bodies) if body]  # Bodies arrive stripped
+        if len(non_empty) < len(email_bodies):  # Handle empty email bodies
+            logger.warning(f"{len(email_bodies) - len(non_empty)} email bodies are empty, selecting default template")
+        if not non_empty:
+            return template_indices
         
-        thread_embedding = model.encode([email_body])
-        distances, indices = faiss_index.search(thread_embedding, 1)
-        best_template_idx = indices[0][0]
-        logger.info(f"Selected template index {best_template_idx} with distance {distances[0][0]}")
-        return EMAIL_TEMPLATES[best_template_idx]
+        # Repeated bodies (bounces, newsletters, form submissions) reuse an earlier decision
+        keys = [hashlib.blake2b(email_bodies[i].lower().encode()).digest() for i in non_empty]
+        uncached = {}
+        for key, i in zip(keys, non_empty):
+            if key not in _template_cache:
+                uncached[key] = email_bodies[i][:MAX_BODY_CHARS]
+        if uncached:
+            # Classify every new body in one call to the embedding worker
+            results = self._classify(list(uncached.values()))
+            if results is None:
+                logger.warning("Embedding worker unavailable, selecting default template")
+                results = []  # Leave these uncached so they are classified once the worker is back
+            for key, (best_template_idx, similarity) in zip(uncached, results):
+                _template_cache[key] = best_template_idx
+                logger.info(f"Selected template index {best_template_idx} with similarity {similarity}")
+        for key, i in zip(keys, non_empty):
+            if key in _template_cache:
+                _template_cache.move_to_end(key)
+                template_indices[i] = _template_cache[key]
+        while len(_template_cache) > TEMPLATE_CACHE_SIZE:
+            _template_cache.popitem(last=False)
+        return template_indices
     
-    def create_standard_reply(self, original_email):
-        """Create a reply message using FAISS to select the template"""
-        # Select the most appropriate template using FAISS
-        reply_template = self.select_template(original_email['body'])
+    def create_standard_reply(self, original_email, template_idx):
+        """Create a reply message from the template selected for this email"""
+        reply_template = EMAIL_TEMPLATES[template_idx]
         
         # Format the reply with original email details
         reply_body = reply_template + f"\n\n---\nOriginal Message:\nSubject: {original_email['subject']}\nFrom: {original_email['sender']}"
         return reply_body
     
+    def find_drafts_folder(self, mail):
+        """Find the drafts folder from its \\Drafts special-use flag (cached after the first LIST)"""
+        if self._drafts_folder is None:
+            drafts_folder = 'Drafts'  # Conventional name if the server flags no folder
+            status, folders = mail.list('""', '*')
+            if status == 'OK':
+                for folder in folders:
+                    match = LIST_RESPONSE.match(folder) if isinstance(folder, bytes) else None
+                    if match and b'\\drafts' in match.group('flags').lower():
+                        drafts_folder = match.group('name').decode()
+                        break
+            self._drafts_folder = drafts_folder
+        return self._drafts_folder
+    
     def save_reply_as_draft(self, original_email, reply_body):
         """Save reply as draft in Drafts folder"""
         try:
@@ -215,29 +357,15 @@ class ZohoEmailProcessor:
             # Add reply body
             reply.attach(MIMEText(reply_body, 'plain'))
             
-            # Connect to IMAP to save draft
-            mail = self.connect_imap()
+            # Reuse this worker's IMAP connection to save the draft
+            mail = self._get_draft_imap()
             if not mail:
                 return False
             
-            # Select or create Drafts folder
-            try:
-                mail.select('Drafts')
-            except:
-                # If Drafts folder doesn't exist, try DRAFT
-                try:
-                    mail.select('DRAFT')
-                except:
-                    logger.error("Could not find Drafts folder")
-                    return False
-            
-            # Save as draft
-            mail.append('Drafts', '\\Draft', imaplib.Time2Internaldate(time.time()), 
+            # Save as draft; APPEND doesn't need the folder selected
+            mail.append(self.find_drafts_folder(mail), '\\Draft', imaplib.Time2Internaldate(time.time()), 
                        reply.as_string().encode('utf-8'))
             
-            mail.close()
-            mail.logout()
-            
             logger.info(f"Draft reply saved for email from {original_email['sender']}")
             return True
             
@@ -256,34 +384,64 @@ class ZohoEmailProcessor:
             logger.info("No new emails found")
             return
         
+        # Select templates for all new emails in one batch
+        template_indices = self.select_templates([email_data['body'] or '' for email_data in emails])
+        
         # Process each email
-        for email_data in emails:
+        futures = {}
+        for email_data, template_idx in zip(emails, template_indices):
             logger.info(f"Processing email from {email_data['sender']}")
             
-            # Create standard reply using FAISS
-            reply_body = self.create_standard_reply(email_data)
+            # Create standard reply from the selected template
+            reply_body = self.create_standard_reply(email_data, template_idx)
             
-            # Save reply as draft
-            if self.save_reply_as_draft(email_data, reply_body):
+            # Save reply as draft; APPENDs overlap across the worker connections
+            futures[self._draft_executor.submit(self.save_reply_as_draft, email_data, reply_body)] = email_data
+        
+        drafted = []
+        for future in as_completed(futures):
+            email_data = futures[future]
+            if future.result():
+                drafted.append(email_data['id'])
+                # Only a saved draft counts; failures are fetched again next cycle
+                self._mark_seen(email_data['id'])
                 logger.info(f"Successfully processed email: {email_data['subject']}")
             else:
                 logger.error(f"Failed to process email: {email_data['subject']}")
+        
+        self.mark_as_read(drafted)
+    
+    def mark_as_read(self, email_ids):
+        """Flag drafted emails \\Seen so UNSEEN stays small and restarts don't re-draft them"""
+        if not email_ids:
+            return
+        try:
+            # STORE runs on the reader connection; select again in case it reconnected
+            mail = self._get_imap()
+            if mail:
+                mail.select('INBOX')
+                mail.uid('STORE', ','.join(email_ids), '+FLAGS', '(\\Seen)')
+        except Exception as e:
+            logger.error(f"Error marking emails as read: {e}")
     
     def run_continuous(self, check_interval=60):
         """Run continuously, checking for new emails at specified intervals"""
         logger.info(f"Starting continuous monitoring (checking every {check_interval} seconds)")
         
-        while True:
-            try:
-                self.process_emails()
-                logger.info(f"Waiting {check_interval} seconds before next check...")
-                time.sleep(check_interval)
-            except KeyboardInterrupt:
-                logger.info("Stopping email processor...")
-                break
-            except Exception as e:
-                logger.error(f"Unexpected error: {e}")
-                time.sleep(30)  # Wait 30 seconds before retrying
+        try:
+            while True:
+                try:
+                    self.process_emails()
+                    logger.info(f"Waiting {check_interval} seconds before next check...")
+                    time.sleep(check_interval)
+                except KeyboardInterrupt:
+                    logger.info("Stopping email processor...")
+                    break
+                except Exception as e:
+                    logger.error(f"Unexpected error: {e}")
+                    time.sleep(30)  # Wait 30 seconds before retrying
+        finally:
+            self.close_connections()
 
 # Usage example
 if __name__ == "__main__":
@@ -1,20 +1,57 @@
 import imaplib
-import smtplib
 import email
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from email.header import decode_header
+import email.policy
+from email.header import Header
+import re
 import time
+import string
 import logging
 import threading
-import select
-import socket
-from datetime import datetime
+import asyncio
+import aioimaplib
+from collections import deque
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Number of processed email IDs remembered to avoid duplicates
+SEEN_WINDOW = 10000
+
+# Longest body kept from an email; replies and template selection only need the start
+MAX_EXTRACTED_CHARS = 4096
+
+# Restart IDLE just under the 29 minutes RFC 2177 allows, before Zoho drops it
+IDLE_TIMEOUT = 29 * 60 - 30
+
+# LIST response line: (flags) "delimiter" name
+LIST_RESPONSE = re.compile(rb'\((?P<flags>[^)]*)\) (?:"[^"]*"|NIL) (?P<name>.+)')
+
+# MIME headers shared by every draft, serialized once
+DRAFT_MIME_HEADERS = (b"MIME-Version: 1.0\r\n"
+                      b"Content-Type: text/plain; charset=utf-8\r\n"
+                      b"Content-Transfer-Encoding: 8bit")
+
+def encode_header(value):
+    """RFC 2047-encode a header value only when it is not plain ASCII"""
+    value = " ".join(value.split())  # Unfold, so a decoded header can't break the header block
+    return value if value.isascii() else Header(value, 'utf-8').encode()
+
+# Standard reply, compiled once at import
+_REPLY_TPL = string.Template("""
+Thank you for your email. I have received your message and will get back to you as soon as possible.
+
+This is an automated response. Please do not reply to this email.
+
+Best regards,
+Auto-Reply System
+
+---
+Original Message:
+Subject: $subject
+From: $sender
+""".strip())
+
 class ZohoEmailIdleProcessor:
     def __init__(self, email_address, password):
         self.email_address = email_address
@@ -23,10 +60,26 @@ class ZohoEmailIdleProcessor:
         self.smtp_server = "smtppro.zoho.com"
         self.imap_port = 993
         self.smtp_port = 587
-        self.processed_emails = set()
+        # Bounded window of processed email IDs; IMAP's UNSEEN flag covers anything older
+        self._seen_recent = deque(maxlen=SEEN_WINDOW)
+        self._seen_ids = set()
         self.running = False
-        self.mail = None
+        # Writer connection for saving drafts; the IDLE connection has to stay in IDLE
+        self._writer_imap = None
+        self._writer_lock = threading.Lock()
+        self._drafts_folder = None  # Discovered on first save
         
+    def _seen(self, email_id):
+        """Check whether an email ID was processed recently"""
+        return email_id in self._seen_ids
+    
+    def _mark_seen(self, email_id):
+        """Remember an email ID, forgetting the oldest once the window is full"""
+        if len(self._seen_recent) == self._seen_recent.maxlen:
+            self._seen_ids.discard(self._seen_recent[0])
+        self._seen_recent.append(email_id)
+        self._seen_ids.add(email_id)
+    
     def connect_imap(self):
         """Connect to IMAP server"""
         try:
@@ -37,101 +90,93 @@ class ZohoEmailIdleProcessor:
             logger.error(f"IMAP connection failed: {e}")
             return None
     
-    def decode_header_value(self, header):
-        """Decode email header"""
-        decoded = decode_header(header)
-        header_value = ""
-        for part, encoding in decoded:
-            if isinstance(part, bytes):
-                header_value += part.decode(encoding or 'utf-8')
-            else:
-                header_value += str(part)
-        return header_value
+    def _get_writer_imap(self):
+        """Return the writer IMAP connection, reconnecting if it has dropped (call with _writer_lock held)"""
+        if self._writer_imap is not None:
+            try:
+                # NOOP doubles as a heartbeat; a dead connection raises or answers non-OK
+                if self._writer_imap.noop()[0] == 'OK':
+                    return self._writer_imap
+            except Exception as e:
+                logger.warning(f"Writer IMAP connection lost, reconnecting: {e}")
+        self._writer_imap = self.connect_imap()
+        return self._writer_imap
+    
+    def decode_part(self, part):
+        """Decode a MIME part's payload using its declared charset"""
+        payload = part.get_payload(decode=True) or b''
+        try:
+            return payload.decode(part.get_content_charset() or 'utf-8', 'replace')
+        except LookupError:  # Unknown charset name
+            return payload.decode('utf-8', 'replace')
     
     def extract_body(self, email_message):
         """Extract email body text"""
         body = ""
-        
-        if email_message.is_multipart():
-            for part in email_message.walk():
-                content_type = part.get_content_type()
-                content_disposition = str(part.get("Content-Disposition"))
-                
-                if content_type == "text/plain" and "attachment" not in content_disposition:
-                    try:
-                        body = part.get_payload(decode=True).decode('utf-8')
-                        break
-                    except:
-                        continue
+        if not email_message.is_multipart():
+            body = self.decode_part(email_message)
         else:
-            try:
-                body = email_message.get_payload(decode=True).decode('utf-8')
-            except:
-                body = str(email_message.get_payload())
+            # Depth-first search that stops at the first inline text/plain part
+            stack = [email_message]
+            while stack:
+                part = stack.pop()
+                if part.is_multipart():
+                    stack.extend(reversed(part.get_payload()))  # Visit parts in document order
+                elif part.get_content_type() == "text/plain" and "attachment" not in str(part.get("Content-Disposition", "")):
+                    body = self.decode_part(part)
+                    break
         
-        return body
+        # Strip once here and bound what gets carried around per email
+        return body.strip()[:MAX_EXTRACTED_CHARS]
     
     def create_standard_reply(self, original_email):
         """Create a standard reply message"""
-        reply_template = """
-Thank you for your email. I have received your message and will get back to you as soon as possible.
-
-This is an automated response. Please do not reply to this email.
-
-Best regards,
-Auto-Reply System
-
----
-Original Message:
-Subject: {subject}
-From: {sender}
-        """.strip()
-        
-        return reply_template.format(
+        return _REPLY_TPL.substitute(
             subject=original_email['subject'],
             sender=original_email['sender']
         )
     
+    def find_drafts_folder(self, mail):
+        """Find the drafts folder from its \\Drafts special-use flag (cached after the first LIST)"""
+        if self._drafts_folder is None:
+            drafts_folder = 'Drafts'  # Conventional name if the server flags no folder
+            status, folders = mail.list('""', '*')
+            if status == 'OK':
+                for folder in folders:
+                    match = LIST_RESPONSE.match(folder) if isinstance(folder, bytes) else None
+                    if match and b'\\drafts' in match.group('flags').lower():
+                        drafts_folder = match.group('name').decode()
+                        break
+            self._drafts_folder = drafts_folder
+        return self._drafts_folder
+    
     def save_reply_as_draft(self, original_email, reply_body):
         """Save reply as draft in Drafts folder"""
         try:
-            # Create reply message
-            reply = MIMEMultipart()
-            reply['From'] = self.email_address
-            reply['To'] = original_email['sender']
-            reply['Subject'] = f"Re: {original_email['subject']}"
+            # Assemble the reply directly instead of running the email package generator
+            subject = f"Re: {original_email['subject']}"
+            headers = [
+                f"From: {encode_header(self.email_address)}".encode(),
+                f"To: {encode_header(original_email['sender'])}".encode(),
+                f"Subject: {encode_header(subject)}".encode(),
+            ]
             
             # Add In-Reply-To and References headers for proper threading
             if original_email['message_id']:
-                reply['In-Reply-To'] = original_email['message_id']
-                reply['References'] = original_email['message_id']
+                headers.append(f"In-Reply-To: {original_email['message_id']}".encode())
+                headers.append(f"References: {original_email['message_id']}".encode())
             
-            # Add reply body
-            reply.attach(MIMEText(reply_body, 'plain'))
+            # imaplib's append() normalizes line endings to CRLF
+            reply = b"\r\n".join(headers + [DRAFT_MIME_HEADERS, b"", reply_body.encode('utf-8')])
             
-            # Connect to IMAP to save draft
-            draft_mail = self.connect_imap()
-            if not draft_mail:
-                return False
-            
-            # Select or create Drafts folder
-            try:
-                draft_mail.select('Drafts')
-            except:
-                try:
-                    draft_mail.select('DRAFT')
-                except:
-                    logger.error("Could not find Drafts folder")
-                    draft_mail.close()
-                    draft_mail.logout()
+            with self._writer_lock:
+                # Reuse the writer connection to save the draft
+                draft_mail = self._get_writer_imap()
+                if not draft_mail:
                     return False
-            
-            # Save as draft
-            draft_mail.append('Drafts', '\\Draft', imaplib.Time2Internaldate(time.time()), 
-                            reply.as_string().encode('utf-8'))
-            
-            draft_mail.close()
-            draft_mail.logout()
+                
+                # Save as draft; APPEND doesn't need the folder selected
+                draft_mail.append(self.find_drafts_folder(draft_mail), '\\Draft', imaplib.Time2Internaldate(time.time()), reply)
             
             logger.info(f"Draft reply saved for email from {original_email['sender']}")
             return True
@@ -140,22 +185,17 @@ From: {sender}
             logger.error(f"Error saving draft: {e}")
             return False
     
-    def process_new_email(self, email_id):
+    def process_new_email(self, email_id, raw_email):
         """Process a single new email"""
         try:
-            # Fetch email
-            status, msg_data = self.mail.fetch(email_id, '(RFC822)')
-            if status != 'OK':
-                return
-            
             # Parse email
-            raw_email = msg_data[0][1]
-            email_message = email.message_from_bytes(raw_email)
+            # The default policy decodes RFC 2047 headers on access
+            email_message = email.message_from_bytes(raw_email, policy=email.policy.default)
             
             # Extract email details
-            subject = self.decode_header_value(email_message.get('Subject', ''))
-            sender = self.decode_header_value(email_message.get('From', ''))
-            message_id = email_message.get('Message-ID', '')
+            subject = str(email_message.get('Subject', ''))
+            sender = str(email_message.get('From', ''))
+            message_id = str(email_message.get('Message-ID', ''))
             
             # Get email body
             body = self.extract_body(email_message)
@@ -178,126 +218,92 @@ From: {sender}
         except Exception as e:
             logger.error(f"Error processing email {email_id}: {e}")
     
-    def idle_loop(self):
+    async def idle(self):
         """Main IDLE loop for real-time email monitoring"""
         while self.running:
+            mail = aioimaplib.IMAP4_SSL(self.imap_server, self.imap_port)
             try:
-                # Connect to IMAP
-                self.mail = self.connect_imap()
-                if not self.mail:
-                    logger.error("Failed to connect to IMAP server")
-                    time.sleep(30)
-                    continue
+                await mail.wait_hello_from_server()
+                await mail.login(self.email_address, self.password)
+                await mail.select('INBOX')
                 
-                # Select INBOX
-                self.mail.select('INBOX')
+                if not mail.has_capability('IDLE'):
+                    # Fallback to polling
+                    await self.fallback_polling(mail)
+                    break
                 
                 logger.info("Starting IMAP IDLE mode - waiting for new emails...")
                 
                 while self.running:
-                    # Start IDLE
-                    tag = self.mail._new_tag()
-                    self.mail.send(f'{tag} IDLE\r\n'.encode())
+                    # Wait for the server to push a mailbox change; the library handles IDLE framing
+                    idle = await mail.idle_start(timeout=IDLE_TIMEOUT)
+                    # idle_start() ends the wait with a stop push at IDLE_TIMEOUT; the margin keeps
+                    # wait_server_push() from timing out first
+                    response = await mail.wait_server_push(timeout=IDLE_TIMEOUT + 30)
+                    mail.idle_done()
+                    await asyncio.wait_for(idle, 30)
+                    logger.debug(f"IDLE response: {response}")
                     
-                    # Wait for response or timeout
-                    response = self.mail.readline()
-                    if b'+ idling' in response.lower():
-                        logger.info("IDLE mode activated - monitoring for new emails...")
-                        
-                        # Wait for notifications
-                        while self.running:
-                            try:
-                                # Use select to wait for data with timeout
-                                ready, _, _ = select.select([self.mail.sock], [], [], 30)
-                                
-                                if ready:
-                                    response = self.mail.readline()
-                                    logger.debug(f"IDLE response: {response}")
-                                    
-                                    # Check if it's a new email notification
-                                    if b'EXISTS' in response:
-                                        logger.info("New email detected!")
-                                        
-                                        # Exit IDLE mode
-                                        self.mail.send(b'DONE\r\n')
-                                        self.mail.readline()  # Read the completion response
-                                        
-                                        # Process new emails
-                                        self.process_recent_emails()
-                                        break
-                                        
-                                else:
-                                    # Timeout - send NOOP to keep connection alive
-                                    logger.debug("IDLE timeout - sending NOOP")
-                                    self.mail.send(b'DONE\r\n')
-                                    self.mail.readline()
-                                    break
-                                    
-                            except socket.timeout:
-                                logger.debug("Socket timeout in IDLE")
-                                break
-                            except Exception as e:
-                                logger.error(f"Error in IDLE loop: {e}")
-                                break
-                    else:
-                        logger.warning(f"IDLE not supported or failed: {response}")
-                        # Fallback to polling
-                        self.fallback_polling()
-                        break
+                    # Check if it's a new email notification
+                    if any(b'EXISTS' in line for line in response if isinstance(line, bytes)):
+                        logger.info("New email detected!")
+                        await self.process_recent_emails(mail)
                         
             except Exception as e:
                 logger.error(f"Error in IDLE loop: {e}")
-                if self.mail:
-                    try:
-                        self.mail.close()
-                        self.mail.logout()
-                    except:
-                        pass
-                time.sleep(30)  # Wait before reconnecting
+                await asyncio.sleep(30)  # Wait before reconnecting
+            finally:
+                try:
+                    await mail.logout()
+                except Exception:
+                    pass
     
-    def process_recent_emails(self):
+    async def process_recent_emails(self, mail):
         """Process recent unread emails"""
         try:
             # Search for unread emails
-            status, messages = self.mail.search(None, 'UNSEEN')
-            if status != 'OK':
+            response = await mail.search('UNSEEN')
+            if response.result != 'OK':
                 return
                 
-            email_ids = messages[0].split()
+            email_ids = response.lines[0].split()
             
             for email_id in email_ids:
-                if email_id.decode() not in self.processed_emails:
-                    self.process_new_email(email_id)
-                    self.processed_emails.add(email_id.decode())
+                if not self._seen(email_id.decode()):
+                    # Fetch email
+                    response = await mail.fetch(email_id.decode(), '(RFC822)')
+                    if response.result != 'OK':
+                        continue
+                    self.process_new_email(email_id, bytes(response.lines[1]))
+                    self._mark_seen(email_id.decode())
                     
         except Exception as e:
             logger.error(f"Error processing recent emails: {e}")
     
-    def fallback_polling(self):
+    async def fallback_polling(self, mail):
         """Fallback to polling if IDLE is not supported"""
         logger.info("IDLE not supported, falling back to polling every 30 seconds")
         
         while self.running:
             try:
-                self.process_recent_emails()
-                time.sleep(30)
+                await self.process_recent_emails(mail)
+                await asyncio.sleep(30)
             except Exception as e:
                 logger.error(f"Error in polling fallback: {e}")
-                time.sleep(30)
+                await asyncio.sleep(30)
     
     def start_monitoring(self):
         """Start the email monitoring"""
         self.running = True
         logger.info("Starting real-time email monitoring...")
         
-        # Start IDLE loop in a separate thread
-        idle_thread = threading.Thread(target=self.idle_loop, daemon=True)
-        idle_thread.start()
+        # Open the writer connection up front so the first draft doesn't pay for the handshake
+        with self._writer_lock:
+            self._get_writer_imap()
         
         try:
-            # Keep main thread alive
-            while self.running:
-                time.sleep(1)
+            # The event loop sleeps until the server pushes something; no wakeup polling
+            asyncio.run(self.idle())
         except KeyboardInterrupt:
             logger.info("Stopping email monitoring...")
             self.stop_monitoring()
@@ -305,13 +311,13 @@ From: {sender}
     def stop_monitoring(self):
         """Stop the email monitoring"""
         self.running = False
-        if self.mail:
-            try:
-                self.mail.send(b'DONE\r\n')  # Exit IDLE mode
-                self.mail.close()
-                self.mail.logout()
-            except:
-                pass
+        with self._writer_lock:
+            if self._writer_imap is not None:
+                try:
+                    self._writer_imap.logout()
+                except:
+                    pass
+                self._writer_imap = None
 
 # Usage example
 if __name__ == "__main__":
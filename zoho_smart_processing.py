@@ -1,19 +1,64 @@
-import imaplib
 import smtplib
 import email
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from email.header import decode_header
+from email.header import Header, decode_header
+from email.utils import formataddr, parseaddr
+import re
+import os
+import json
+import tempfile
+import signal
 import time
+import random
 import logging
-from datetime import datetime, timedelta
-import threading
-import queue
+from datetime import datetime
+from functools import lru_cache
+import asyncio
+import aioimaplib
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Messages fetched per FETCH command
+FETCH_BATCH_SIZE = 100
+# Only the headers the reply needs; BODY.PEEK leaves the \Seen flag alone
+FETCH_ITEMS = '(BODY.PEEK[HEADER.FIELDS (SUBJECT FROM MESSAGE-ID)] UID)'
+UID_PATTERN = re.compile(rb'UID (\d+)')
+UIDVALIDITY_PATTERN = re.compile(rb'\[UIDVALIDITY (\d+)\]')
+# Where the INBOX UID high-water mark is kept between runs
+STATE_FILE = os.path.expanduser('~/.zoho_processor.state')
+# LIST response line: (flags) "delimiter" name
+LIST_RESPONSE = re.compile(rb'\((?P<flags>[^)]*)\) (?:"[^"]*"|NIL) (?P<name>.+)')
+
+def _batched(items, size):
+    """Yield successive lists of at most size items"""
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+# Fixed part of every reply body, ahead of the quoted original. Lines end in CRLF because
+# aioimaplib sends the APPEND literal as-is, without imaplib's newline conversion.
+REPLY_BOILERPLATE = (b"Thank you for your email. I have received your message and will get back to you as soon as possible.\r\n"
+                     b"\r\n"
+                     b"This is an automated response. Please do not reply to this email.\r\n"
+                     b"\r\n"
+                     b"Best regards,\r\n"
+                     b"Auto-Reply System\r\n"
+                     b"\r\n"
+                     b"---\r\n"
+                     b"Original Message:\r\n")
+
+def encode_header(value):
+    """RFC 2047-encode a header value only when it is not plain ASCII"""
+    value = " ".join(value.split())  # Unfold, so a decoded header can't break the header block
+    return value if value.isascii() else Header(value, 'utf-8').encode()
+
+# Re-issue IDLE before the 30-minute limit from RFC 2177
+IDLE_TIMEOUT = 29 * 60
+# Concurrent draft workers, each APPENDing over its own pooled connection
+REPLY_WORKERS = 4
+# First retry delay in seconds; doubles with each consecutive failure
+INITIAL_BACKOFF = 1.0
+
 class ZohoSmartPollingProcessor:
     def __init__(self, email_address, password):
         self.email_address = email_address
@@ -22,181 +67,244 @@ class ZohoSmartPollingProcessor:
         self.smtp_server = "smtppro.zoho.com"
         self.imap_port = 993
         self.smtp_port = 587
-        self.processed_emails = set()
+        self.last_uid = None  # Highest INBOX UID already handled
+        self.uidvalidity = None
+        self._saved_state = None  # (uidvalidity, last_uid) from the state file
         self.running = False
         self.last_email_time = datetime.now()
-        self.current_interval = 60  # Start with 60 seconds
-        self.min_interval = 10      # Minimum 10 seconds
-        self.max_interval = 300     # Maximum 5 minutes
-        self.email_queue = queue.Queue()
+        # Polling only runs when the server lacks IDLE, so keep the bounds tight
+        self.current_interval = 30  # Start with 30 seconds
+        self.min_interval = 5       # Minimum 5 seconds
+        self.max_interval = 60      # Maximum 1 minute
+        self.attempt = 0            # Consecutive failures, drives the retry backoff
+        self.email_queue = asyncio.Queue()
+        # Reader connection for IDLE/SEARCH/FETCH and a pool of writer connections for APPEND
+        self._imap = None
+        self._writers = asyncio.Queue()
+        for _ in range(REPLY_WORKERS):
+            self._writers.put_nowait(None)  # Slots connect on first use
+        self._loop = None        # Event loop running run(), set once it starts
+        self._stop_event = None
+        self._selected_folder = None
+        self.drafts_folder = None  # Discovered on first save
+        # Headers shared by every draft, built once instead of through the MIME generator
+        self._reply_header_template = (f"From: {encode_header(self.email_address)}\r\n"
+                                       "MIME-Version: 1.0\r\n"
+                                       "Content-Type: text/plain; charset=utf-8\r\n"
+                                       "Content-Transfer-Encoding: 8bit\r\n")
         
-    def connect_imap(self):
+    async def connect_imap(self):
         """Connect to IMAP server"""
         try:
-            mail = imaplib.IMAP4_SSL(self.imap_server, self.imap_port)
-            mail.login(self.email_address, self.password)
+            mail = aioimaplib.IMAP4_SSL(self.imap_server, self.imap_port)
+            await mail.wait_hello_from_server()
+            response = await mail.login(self.email_address, self.password)
+            if response.result != 'OK':
+                raise aioimaplib.Abort(f"login failed: {response.lines}")
             return mail
         except Exception as e:
             logger.error(f"IMAP connection failed: {e}")
             return None
     
+    async def _is_alive(self, mail):
+        """Check a connection with NOOP, which doubles as a keepalive"""
+        try:
+            return (await mail.noop()).result == 'OK'
+        except Exception as e:
+            logger.warning(f"IMAP connection lost, reconnecting: {e}")
+            return False
+    
+    async def _get_imap(self):
+        """Return the reader connection (IDLE, SEARCH, FETCH), reconnecting if it has dropped"""
+        if self._imap is None or not await self._is_alive(self._imap):
+            self._imap = await self.connect_imap()
+            self._selected_folder = None
+        return self._imap
+    
+    async def _select(self, mail, folder):
+        """SELECT a folder unless it is already the selected one"""
+        if self._selected_folder != folder:
+            response = await mail.select(folder)
+            if response.result != 'OK':
+                return False
+            self._selected_folder = folder
+            for line in response.lines:
+                match = UIDVALIDITY_PATTERN.search(bytes(line))
+                if match:
+                    self.uidvalidity = int(match.group(1))
+        return True
+    
+    def load_state(self):
+        """Restore the UID high-water mark saved by a previous run"""
+        try:
+            with open(STATE_FILE) as f:
+                state = json.load(f)
+            self._saved_state = (state['uidvalidity'], state['last_uid'])
+        except (OSError, ValueError, KeyError) as e:
+            logger.debug(f"No saved state loaded: {e}")
+    
+    def save_state(self):
+        """Write the UID high-water mark atomically so a restart resumes where it stopped"""
+        if self.last_uid is None or self.uidvalidity is None:
+            return
+        try:
+            with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(STATE_FILE), delete=False) as tmp:
+                json.dump({'uidvalidity': self.uidvalidity, 'last_uid': self.last_uid}, tmp)
+            os.replace(tmp.name, STATE_FILE)
+        except OSError as e:
+            logger.error(f"Error saving state: {e}")
+    
+    async def _find_drafts_folder(self, mail):
+        """Find the drafts folder from its \\Drafts special-use flag (cached after the first LIST)"""
+        if self.drafts_folder is None:
+            drafts_folder = 'Drafts'  # Conventional name if the server flags no folder
+            response = await mail.list('""', '*')
+            if response.result == 'OK':
+                for folder in response.lines:
+                    match = LIST_RESPONSE.match(folder) if isinstance(folder, bytes) else None
+                    if match and b'\\drafts' in match.group('flags').lower():
+                        drafts_folder = match.group('name').decode()
+                        break
+            self.drafts_folder = drafts_folder
+        return self.drafts_folder
+    
     def decode_header_value(self, header):
         """Decode email header"""
-        decoded = decode_header(header)
-        header_value = ""
-        for part, encoding in decoded:
-            if isinstance(part, bytes):
-                header_value += part.decode(encoding or 'utf-8')
-            else:
-                header_value += str(part)
-        return header_value
+        header = str(header)
+        if '=?' not in header:  # No encoded words, nothing to decode
+            return header
+        return self._decode_encoded_header(header)
     
-    def extract_body(self, email_message):
-        """Extract email body text"""
-        body = ""
-        
-        if email_message.is_multipart():
-            for part in email_message.walk():
-                content_type = part.get_content_type()
-                content_disposition = str(part.get("Content-Disposition"))
-                
-                if content_type == "text/plain" and "attachment" not in content_disposition:
-                    try:
-                        body = part.get_payload(decode=True).decode('utf-8')
-                        break
-                    except:
-                        continue
-        else:
-            try:
-                body = email_message.get_payload(decode=True).decode('utf-8')
-            except:
-                body = str(email_message.get_payload())
-        
-        return body
+    @staticmethod
+    @lru_cache(maxsize=4096)  # Senders and subjects repeat across messages
+    def _decode_encoded_header(header):
+        """Decode a header containing RFC 2047 encoded words"""
+        # Unlabelled parts are plain ASCII per RFC 5322
+        return ''.join(part.decode(encoding or 'ascii', errors='replace') if isinstance(part, bytes)
+                       else str(part)
+                       for part, encoding in decode_header(header))
     
     def create_standard_reply(self, original_email):
-        """Create a standard reply message"""
-        reply_template = """
-Thank you for your email. I have received your message and will get back to you as soon as possible.
-
-This is an automated response. Please do not reply to this email.
-
-Best regards,
-Auto-Reply System
-
----
-Original Message:
-Subject: {subject}
-From: {sender}
-        """.strip()
-        
-        return reply_template.format(
-            subject=original_email['subject'],
-            sender=original_email['sender']
-        )
+        """Create a standard reply message as UTF-8 bytes"""
+        # Only the quoted subject and sender vary; the boilerplate is encoded once at import
+        # Unfold the quoted headers so no bare LF from a folded header reaches the body
+        subject = " ".join(original_email['subject'].split())
+        sender = " ".join(original_email['sender'].split())
+        return REPLY_BOILERPLATE + f"Subject: {subject}\r\nFrom: {sender}".encode('utf-8')
     
-    def save_reply_as_draft(self, original_email, reply_body):
+    async def save_reply_as_draft(self, original_email, reply_body):
         """Save reply as draft in Drafts folder"""
         try:
-            reply = MIMEMultipart()
-            reply['From'] = self.email_address
-            reply['To'] = original_email['sender']
-            reply['Subject'] = f"Re: {original_email['subject']}"
+            # Only the per-reply headers are formatted; the rest is the prebuilt block
+            # formataddr encodes only the display name, keeping the address readable
+            headers = (f"To: {formataddr(parseaddr(original_email['sender']))}\r\n"
+                       f"Subject: {encode_header('Re: ' + original_email['subject'])}\r\n")
             
             if original_email['message_id']:
-                reply['In-Reply-To'] = original_email['message_id']
-                reply['References'] = original_email['message_id']
+                headers += (f"In-Reply-To: {original_email['message_id']}\r\n"
+                            f"References: {original_email['message_id']}\r\n")
             
-            reply.attach(MIMEText(reply_body, 'plain'))
+            reply = (self._reply_header_template + headers + "\r\n").encode('utf-8') + reply_body
             
-            mail = self.connect_imap()
+        except Exception as e:
+            logger.error(f"Error building draft: {e}")
+            return False
+        
+        # APPENDs go over pooled connections so they never wait behind IDLE or FETCH
+        mail = await self._writers.get()
+        try:
+            if mail is None or not await self._is_alive(mail):
+                mail = await self.connect_imap()
             if not mail:
                 return False
             
-            try:
-                mail.select('Drafts')
-            except:
-                try:
-                    mail.select('DRAFT')
-                except:
-                    logger.error("Could not find Drafts folder")
-                    mail.close()
-                    mail.logout()
-                    return False
-            
-            mail.append('Drafts', '\\Draft', imaplib.Time2Internaldate(time.time()), 
-                       reply.as_string().encode('utf-8'))
-            
-            mail.close()
-            mail.logout()
+            response = await mail.append(reply,
+                                         mailbox=await self._find_drafts_folder(mail),
+                                         flags='\\Draft', date=time.time())
+            if response.result != 'OK':
+                logger.error(f"Error saving draft: {response.lines}")
+                return False
             
-            logger.info(f"Draft reply saved for email from {original_email['sender']}")
+            logger.info("Draft reply saved for email from %s", original_email['sender'])
             return True
             
         except Exception as e:
             logger.error(f"Error saving draft: {e}")
+            mail = None  # Reconnect on the next call
             return False
+        finally:
+            self._writers.put_nowait(mail)
     
-    def get_new_emails(self):
-        """Fetch new emails since last check"""
-        mail = self.connect_imap()
+    async def get_new_emails(self):
+        """Fetch new emails since last check; None if the check failed"""
+        mail = await self._get_imap()
         if not mail:
-            return []
+            return None
         
         try:
-            mail.select('INBOX')
+            if not await self._select(mail, 'INBOX'):
+                logger.error("Failed to select INBOX")
+                return None
             
-            # Search for emails since last check (more efficient)
-            since_date = (datetime.now() - timedelta(minutes=10)).strftime("%d-%b-%Y")
-            status, messages = mail.search(None, f'(UNSEEN SINCE {since_date})')
+            if self.last_uid is None and self._saved_state:
+                # Saved UIDs are only meaningful while the mailbox keeps its UIDVALIDITY
+                uidvalidity, last_uid = self._saved_state
+                if uidvalidity == self.uidvalidity:
+                    self.last_uid = last_uid
+                    logger.info(f"Resuming after UID {last_uid}")
             
-            if status != 'OK':
-                logger.error("Failed to search for emails")
+            if self.last_uid is None:
+                # Start from the newest message; mail arriving from now on gets a draft
+                response = await mail.uid_search('ALL', charset=None)
+                if response.result != 'OK':
+                    logger.error("Failed to search for emails")
+                    return None
+                self.last_uid = max(map(int, response.lines[0].split()), default=0)
+                self.save_state()
                 return []
             
-            email_ids = messages[0].split()
+            # UIDs survive expunges, unlike sequence numbers, so only the high-water mark is kept
+            response = await mail.uid_search(f'UID {self.last_uid + 1}:* UNSEEN', charset=None)
+            
+            if response.result != 'OK':
+                logger.error("Failed to search for emails")
+                return None
+            
+            # "N:*" always matches the newest message, even when its UID is below N
+            email_ids = [uid for uid in response.lines[0].split() if int(uid) > self.last_uid]
             emails = []
             
-            for email_id in email_ids:
-                if email_id.decode() in self.processed_emails:
+            # Fetch new emails in batches, one round trip per batch
+            for chunk in _batched(email_ids, FETCH_BATCH_SIZE):
+                response = await mail.uid('FETCH', b','.join(chunk).decode(), FETCH_ITEMS)
+                if response.result != 'OK':
                     continue
                 
-                # Fetch email
-                status, msg_data = mail.fetch(email_id, '(RFC822)')
-                if status != 'OK':
-                    continue
-                
-                # Parse email
-                raw_email = msg_data[0][1]
-                email_message = email.message_from_bytes(raw_email)
-                
-                # Extract email details
-                subject = self.decode_header_value(email_message.get('Subject', ''))
-                sender = self.decode_header_value(email_message.get('From', ''))
-                message_id = email_message.get('Message-ID', '')
-                
-                # Get email body
-                body = self.extract_body(email_message)
-                
-                emails.append({
-                    'id': email_id.decode(),
-                    'subject': subject,
-                    'sender': sender,
-                    'body': body,
-                    'message_id': message_id,
-                    'email_object': email_message
-                })
+                lines = response.lines
+                for index, literal in enumerate(lines):
+                    if not isinstance(literal, bytearray):  # Headers arrive as bytearray literals
+                        continue
+                    
+                    # The UID is in the line before the literal or in the closing line after it
+                    trailer = lines[index + 1] if index + 1 < len(lines) else b''
+                    uid = UID_PATTERN.search(bytes(lines[index - 1]) + bytes(trailer))
+                    if not uid:
+                        continue
+                    email_id = int(uid.group(1))
+                    
+                    # Headers are parsed by the workers; the reader goes straight back to IDLE
+                    emails.append({'uid': email_id, 'raw': bytes(literal)})
+                    self.last_uid = max(self.last_uid, email_id)
                 
-                self.processed_emails.add(email_id.decode())
-                logger.info(f"Found new email from {sender}: {subject}")
+                # Persist per batch so a crash can't resume from a stale mark or skip the gap
+                self.save_state()
             
-            mail.close()
-            mail.logout()
             return emails
             
         except Exception as e:
             logger.error(f"Error fetching emails: {e}")
-            return []
+            self._imap = None  # Reconnect on the next call
+            return None
     
     def adjust_polling_interval(self, found_emails):
         """Dynamically adjust polling interval based on email activity"""
@@ -204,38 +312,112 @@ From: {sender}
             # New emails found - increase frequency (decrease interval)
             self.current_interval = max(self.min_interval, self.current_interval * 0.5)
             self.last_email_time = datetime.now()
-            logger.info(f"New emails found - reducing interval to {self.current_interval} seconds")
+            logger.info("New emails found - reducing interval to %s seconds", self.current_interval)
         else:
             # No new emails - decrease frequency (increase interval)
             time_since_last_email = (datetime.now() - self.last_email_time).total_seconds()
             
             if time_since_last_email > 600:  # 10 minutes without emails
                 self.current_interval = min(self.max_interval, self.current_interval * 1.2)
-                logger.debug(f"No activity - increasing interval to {self.current_interval} seconds")
+                logger.debug("No activity - increasing interval to %s seconds", self.current_interval)
+    
+    def backoff_delay(self):
+        """Exponential backoff with full jitter, capped at max_interval"""
+        # Exponent clamped so a long outage can't overflow the float
+        delay = random.uniform(0, min(self.max_interval, INITIAL_BACKOFF * 2 ** min(self.attempt, 10)))
+        self.attempt += 1
+        return delay
+    
+    def parse_email(self, email_data):
+        """Parse the fetched headers into the fields a reply needs"""
+        email_message = email.message_from_bytes(email_data['raw'])
+        
+        # Extract email details
+        subject = self.decode_header_value(email_message.get('Subject', ''))
+        sender = self.decode_header_value(email_message.get('From', ''))
+        logger.info("Found new email from %s: %s", sender, subject)
+        
+        return {
+            'id': email_data['uid'],
+            'subject': subject,
+            'sender': sender,
+            'message_id': email_message.get('Message-ID', ''),
+            'email_object': email_message
+        }
+    
+    async def process_email(self, email_data):
+        """Create and save the reply for one email"""
+        email_data = self.parse_email(email_data)
+        reply_body = self.create_standard_reply(email_data)
+        if await self.save_reply_as_draft(email_data, reply_body):
+            logger.info("Successfully processed email: %s", email_data['subject'])
+        else:
+            logger.error(f"Failed to process email: {email_data['subject']}")
     
-    def email_processor_worker(self):
+    async def email_processor_worker(self):
         """Background worker to process emails from queue"""
-        while self.running:
+        while True:
+            # Sleeps until something is queued; None is the shutdown signal
+            email_data = await self.email_queue.get()
             try:
-                email_data = self.email_queue.get(timeout=1)
-                if email_data is None:  # Shutdown signal
+                if email_data is None:
                     break
+                await self.process_email(email_data)
+            except Exception as e:
+                logger.error(f"Error in email processor worker: {e}")
+            finally:
+                self.email_queue.task_done()
+    
+    async def queue_new_emails(self):
+        """Fetch new emails and hand them to the processing worker"""
+        new_emails = await self.get_new_emails()
+        if new_emails is None:
+            raise ConnectionError("Checking for new emails failed")  # Caller backs off and retries
+        for email_data in new_emails:
+            self.email_queue.put_nowait(email_data)
+        return new_emails
+    
+    async def idle_loop(self):
+        """Main IDLE loop; falls back to smart polling if the server lacks IDLE"""
+        logger.info("Starting IMAP IDLE email monitor...")
+        
+        while self.running:
+            try:
+                mail = await self._get_imap()
+                if not mail:
+                    await asyncio.sleep(self.backoff_delay())
+                    continue
                 
-                # Process email
-                reply_body = self.create_standard_reply(email_data)
-                if self.save_reply_as_draft(email_data, reply_body):
-                    logger.info(f"Successfully processed email: {email_data['subject']}")
-                else:
-                    logger.error(f"Failed to process email: {email_data['subject']}")
+                if not mail.has_capability('IDLE'):
+                    logger.info("IDLE not supported, falling back to smart polling")
+                    await self.smart_polling_loop()
+                    return
                 
-                self.email_queue.task_done()
+                # Pick up anything that arrived while we weren't idling (also selects INBOX)
+                await self.queue_new_emails()
                 
-            except queue.Empty:
-                continue
+                while self.running:
+                    # Wait for the server to push a mailbox change; the library handles IDLE framing
+                    idle = await mail.idle_start(timeout=IDLE_TIMEOUT)
+                    # idle_start() ends the wait with a stop push at IDLE_TIMEOUT
+                    response = await mail.wait_server_push(timeout=IDLE_TIMEOUT + 30)
+                    mail.idle_done()
+                    await asyncio.wait_for(idle, 30)
+                    logger.debug("IDLE response: %s", response)
+                    
+                    if any(line.rstrip().endswith((b'EXISTS', b'RECENT'))
+                           for line in response if isinstance(line, bytes)):
+                        logger.info("New email detected!")
+                        await self.queue_new_emails()
+                    # A full IDLE cycle went through; only now is the connection known good
+                    self.attempt = 0
+                        
             except Exception as e:
-                logger.error(f"Error in email processor worker: {e}")
+                logger.error(f"Error in IDLE loop: {e}")
+                self._imap = None
+                await asyncio.sleep(self.backoff_delay())  # Wait before reconnecting
     
-    def smart_polling_loop(self):
+    async def smart_polling_loop(self):
         """Main smart polling loop"""
         logger.info("Starting smart polling email monitor...")
         
@@ -243,46 +425,62 @@ From: {sender}
             try:
                 start_time = time.time()
                 
-                # Check for new emails
-                new_emails = self.get_new_emails()
-                
-                # Add new emails to processing queue
-                for email_data in new_emails:
-                    self.email_queue.put(email_data)
+                # Check for new emails and add them to the processing queue
+                new_emails = await self.queue_new_emails()
                 
                 # Adjust polling interval based on activity
                 self.adjust_polling_interval(new_emails)
+                self.attempt = 0
                 
-                # Calculate sleep time
+                # Calculate sleep time, jittered so many processors don't poll in lockstep
                 processing_time = time.time() - start_time
-                sleep_time = max(1, self.current_interval - processing_time)
+                sleep_time = max(1, self.current_interval * random.uniform(0.8, 1.2) - processing_time)
                 
-                logger.debug(f"Processed {len(new_emails)} emails in {processing_time:.2f}s. "
-                           f"Sleeping for {sleep_time:.1f}s (interval: {self.current_interval}s)")
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Processed %d emails in %.2fs. Sleeping for %.1fs (interval: %ss)",
+                                 len(new_emails), processing_time, sleep_time, self.current_interval)
                 
-                time.sleep(sleep_time)
+                await asyncio.sleep(sleep_time)
                 
             except Exception as e:
                 logger.error(f"Error in smart polling loop: {e}")
-                time.sleep(30)  # Wait before retrying
+                await asyncio.sleep(self.backoff_delay())  # Wait before retrying
+    
+    async def run(self):
+        """Run the processing workers and the IDLE monitor on one event loop"""
+        self.load_state()
+        self._loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+        # systemd/docker stop with SIGTERM; shut down cleanly so the state is saved
+        self._loop.add_signal_handler(signal.SIGTERM, self._stop_event.set)
+        workers = [asyncio.create_task(self.email_processor_worker()) for _ in range(REPLY_WORKERS)]
+        monitor = asyncio.create_task(self.idle_loop())
+        try:
+            await self._stop_event.wait()
+        finally:
+            monitor.cancel()
+            for _ in workers:
+                self.email_queue.put_nowait(None)  # Workers finish what is queued, then exit
+            await asyncio.gather(monitor, *workers, return_exceptions=True)
+            self.save_state()
+            connections = [self._imap]
+            while not self._writers.empty():
+                connections.append(self._writers.get_nowait())
+            for mail in connections:
+                if mail is not None:
+                    try:
+                        await mail.logout()
+                    except Exception:
+                        pass
+            self._imap = None
     
     def start_monitoring(self):
         """Start the smart email monitoring"""
         self.running = True
         logger.info("Starting smart email monitoring system...")
         
-        # Start email processor worker thread
-        processor_thread = threading.Thread(target=self.email_processor_worker, daemon=True)
-        processor_thread.start()
-        
-        # Start polling thread
-        polling_thread = threading.Thread(target=self.smart_polling_loop, daemon=True)
-        polling_thread.start()
-        
         try:
-            # Keep main thread alive
-            while self.running:
-                time.sleep(1)
+            asyncio.run(self.run())
         except KeyboardInterrupt:
             logger.info("Stopping email monitoring...")
             self.stop_monitoring()
@@ -290,15 +488,16 @@ From: {sender}
     def stop_monitoring(self):
         """Stop the email monitoring"""
         self.running = False
-        # Send shutdown signal to worker
-        self.email_queue.put(None)
+        # Safe from any thread; wakes run() so it can shut the tasks down
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._stop_event.set)
         logger.info("Email monitoring stopped")
 
 # Usage example
 if __name__ == "__main__":
-    # Replace with your Zoho email credentials
-    EMAIL_ADDRESS = "support@getagentstudio.com"
-    PASSWORD = "AgenT@007Studi0DxB"  # Use app-specific password if 2FA is enabled
+    # Zoho email credentials come from the environment
+    EMAIL_ADDRESS = os.environ['ZOHO_EMAIL']
+    PASSWORD = os.environ['ZOHO_PASSWORD']  # Use app-specific password if 2FA is enabled
     
     # Create processor instance
     processor = ZohoSmartPollingProcessor(EMAIL_ADDRESS, PASSWORD)
@@ -1,9 +1,9 @@
 import imaplib
 import smtplib
 import email
+import email.policy
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from email.header import decode_header
 import time
 import logging
 from datetime import datetime, timedelta
@@ -63,7 +63,7 @@ class ZohoSmartPollingProcessor:
         self.smtp_server = "smtppro.zoho.com"
         self.imap_port = 993
         self.smtp_port = 587
-        self.processed_emails = set()
+        self.processed_emails = set()  # Sequence numbers as returned by SEARCH (bytes)
         self.running = False
         self.last_email_time = datetime.now()
         self.current_interval = 60  # Start with 60 seconds
@@ -81,39 +81,16 @@ class ZohoSmartPollingProcessor:
             logger.error(f"IMAP connection failed: {e}")
             return None
     
-    def decode_header_value(self, header):
-        """Decode email header"""
-        decoded = decode_header(header)
-        header_value = ""
-        for part, encoding in decoded:
-            if isinstance(part, bytes):
-                header_value += part.decode(encoding or 'utf-8')
-            else:
-                header_value += str(part)
-        return header_value
-    
     def extract_body(self, email_message):
         """Extract email body text"""
-        body = ""
-        
-        if email_message.is_multipart():
-            for part in email_message.walk():
-                content_type = part.get_content_type()
-                content_disposition = str(part.get("Content-Disposition"))
-                
-                if content_type == "text/plain" and "attachment" not in content_disposition:
-                    try:
-                        body = part.get_payload(decode=True).decode('utf-8')
-                        break
-                    except:
-                        continue
-        else:
-            try:
-                body = email_message.get_payload(decode=True).decode('utf-8')
-            except:
-                body = str(email_message.get_payload())
-        
-        return body
+        # get_body() picks the text/plain part without walking or decoding attachments
+        part = email_message.get_body(preferencelist=('plain',))
+        if part is None:
+            return ""
+        try:
+            return part.get_content()
+        except (LookupError, UnicodeDecodeError):  # Unknown or mislabelled charset
+            return part.get_payload(decode=True).decode('utf-8', errors='replace')
     
     def select_template(self, email_body):
         """Select the most relevant email template using FAISS."""
@@ -204,7 +181,7 @@ class ZohoSmartPollingProcessor:
             emails = []
             
             for email_id in email_ids:
-                if email_id.decode() in self.processed_emails:
+                if email_id in self.processed_emails:
                     continue
                 
                 # Fetch email
@@ -214,12 +191,13 @@ class ZohoSmartPollingProcessor:
                 
                 # Parse email
                 raw_email = msg_data[0][1]
-                email_message = email.message_from_bytes(raw_email)
+                # The default policy decodes RFC 2047 headers on access
+                email_message = email.message_from_bytes(raw_email, policy=email.policy.default)
                 
                 # Extract email details
-                subject = self.decode_header_value(email_message.get('Subject', ''))
-                sender = self.decode_header_value(email_message.get('From', ''))
-                message_id = email_message.get('Message-ID', '')
+                subject = str(email_message.get('Subject', ''))
+                sender = str(email_message.get('From', ''))
+                message_id = str(email_message.get('Message-ID', ''))
                 
                 # Get email body
                 body = self.extract_body(email_message)
@@ -233,7 +211,7 @@ class ZohoSmartPollingProcessor:
                     'email_object': email_message
                 })
                 
-                self.processed_emails.add(email_id.decode())
+                self.processed_emails.add(email_id)
                 logger.info(f"Found new email from {sender}: {subject}")
             
             mail.close()